@@ -1,8 +1,25 @@
 import os
+import json
+import time
+import random
+import hashlib
+import threading
+from functools import lru_cache
+import httpx
+import numpy as np
 import pandas as pd
 import tiktoken
-from openai import AzureOpenAI, BadRequestError
-from tenacity import retry, stop_after_attempt, wait_exponential
+from openai import AzureOpenAI, BadRequestError, RateLimitError
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from orjson import loads as json_loads  # Much faster than json for large numbers of responses
+except ImportError:
+    from json import loads as json_loads
+from completion_cache import CompletionCache, get_default_cache
+from llm_telemetry import CallRecord, get_registry
 
 
 ##################################################
@@ -29,10 +46,18 @@ these steps:
 """
 
 class AzureAPIConfig:
-    def __init__(self, api_key: str, api_version: str, endpoint: str) -> None:
+    def __init__(self, api_key: str, api_version: str, endpoint: str, max_connections: int = 100, 
+                 max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0) -> None:
         self.api_key = api_key
         self.api_version = api_version
         self.endpoint = endpoint
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+
+    def client_key(self):
+        """Identifies the endpoint/version/credentials a client was built for."""
+        return (self.endpoint, self.api_version, self.api_key)
 
 def get_default_api_config(choice=0):
     configurations = [
@@ -45,6 +70,66 @@ def get_default_api_config(choice=0):
     return configurations[choice]
 
 
+##################################################
+#    Shared API clients
+##################################################
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _mark_request_sent(request):
+    request.extensions['sent_at'] = time.perf_counter()
+
+
+def _mark_headers_received(response):
+    response.request.extensions['headers_received_at'] = time.perf_counter()
+
+
+def _get_time_to_first_byte(raw_response):
+    """Returns the seconds between sending the request and receiving the response headers."""
+    extensions = raw_response.http_response.request.extensions
+    if 'sent_at' in extensions and 'headers_received_at' in extensions:
+        return extensions['headers_received_at'] - extensions['sent_at']
+    return None
+
+
+def _get_http_limits(api_config: AzureAPIConfig):
+    return httpx.Limits(max_connections=api_config.max_connections,
+                        max_keepalive_connections=api_config.max_keepalive_connections,
+                        keepalive_expiry=api_config.keepalive_expiry)
+
+
+def get_client(api_config: AzureAPIConfig):
+    """
+    Returns a long-lived AzureOpenAI client for the given API configuration. Clients are created
+    once per endpoint/version and reused, so their connection pool (and the TLS sessions in it)
+    survives across requests and retries. The client is thread-safe. The SDK's built-in retries
+    are disabled so that 429s reach the shared RateController.
+    """
+    key = api_config.client_key()
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = AzureOpenAI(
+                api_key=api_config.api_key,  
+                api_version=api_config.api_version,
+                azure_endpoint=api_config.endpoint,
+                max_retries=0,  # Retries are handled by the RateController
+                http_client=httpx.Client(limits=_get_http_limits(api_config), 
+                                         event_hooks={'request': [_mark_request_sent], 'response': [_mark_headers_received]})
+            )
+        return _clients[key]
+
+
+def close_clients():
+    """
+    Closes and forgets all pooled clients, e.g. after rotating API keys.
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
 ##################################################
 #    Configurations for Azure OpenAI Models
 ##################################################
@@ -66,6 +151,9 @@ class AzureOpenAIConfig:
         self.max_array_size = max_array_size
         
 
+EMBEDDING_MAX_INPUT_TOKENS = 8191  # Input tokens per embedding request accepted by text-embedding-ada-002
+
+
 def get_default_model_config(choice=0):
     configurations = [
         AzureOpenAIConfig(
@@ -100,6 +188,7 @@ def get_default_model_config(choice=0):
             max_iterations=100,
             input_cost=0.01,
             output_cost=0.03,
+            max_input=EMBEDDING_MAX_INPUT_TOKENS,
             max_array_size=2048
             )
         ]
@@ -110,15 +199,23 @@ def get_default_model_config(choice=0):
 #    Helper functions
 ##################################################
 
-def get_tokenizer(model_config: AzureOpenAIConfig):
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
     try:
-        encoding = tiktoken.encoding_for_model(model_config.model)
+        encoding = tiktoken.encoding_for_model(model)
     except KeyError:
         print("Warning: Encoding not found. Using cl100k_base encoding.")
         encoding = tiktoken.get_encoding("cl100k_base")
     return encoding
 
 
+def get_tokenizer(model_config: AzureOpenAIConfig):
+    """
+    Returns the tiktoken encoding for the model. Encodings are looked up once per model and reused.
+    """
+    return _get_encoding(model_config.model)
+
+
 def estimate_num_tokens_from_str(string, model_config):
     """
     Returns the number of tokens in a text string.
@@ -127,6 +224,25 @@ def estimate_num_tokens_from_str(string, model_config):
     return len(encoding.encode(string))
 
 
+def count_tokens_batch(strings: list, model_config: AzureOpenAIConfig, num_threads: int = 8):
+    """
+    Returns the number of tokens in each string, encoding the whole list at once across num_threads threads.
+    """
+    encoding = get_tokenizer(model_config)
+    return [len(tokens) for tokens in encoding.encode_batch(list(strings), num_threads=num_threads)]
+
+
+def get_token_counts(df: pd.DataFrame, source_col: str, model_config: AzureOpenAIConfig, num_threads: int = 8):
+    """
+    Returns a Series (indexed like df) with the number of tokens in each item of source_col.
+
+    Counts are for the items alone, so the same counts can be reused with different prompts. The 
+    count of prompt + item can differ from prompt count + item count by a token at the boundary.
+    """
+    counts = count_tokens_batch(df[source_col].tolist(), model_config, num_threads=num_threads)
+    return pd.Series(counts, index=df.index, name=f"{source_col}_num_tokens", dtype='int64')
+
+
 def get_cost(usage_obj, model_config: AzureOpenAIConfig):
     """
     Returns the total cost of an API call.
@@ -134,130 +250,708 @@ def get_cost(usage_obj, model_config: AzureOpenAIConfig):
     return ((usage_obj.prompt_tokens/1000) * model_config.input_cost) + ((usage_obj.completion_tokens/1000) * model_config.output_cost)
 
 
+def get_response_cost(response, prompt: str, model_config: AzureOpenAIConfig, num_prompt_tokens: int = None):
+    """
+    Returns the cost of a completion call. Requests rejected with a 400 (response is False)
+    are still billed for their input tokens, which are counted unless num_prompt_tokens is given.
+    """
+    if response:
+        return get_cost(response.usage, model_config)
+    if num_prompt_tokens is None:
+        num_prompt_tokens = estimate_num_tokens_from_str(prompt, model_config)
+    return num_prompt_tokens/1000 * model_config.input_cost
+
+
+def pack_token_batches(token_counts: pd.Series, budget_tokens: int, max_items: int):
+    """
+    Greedily packs rows, in order, into batches whose token counts sum to at most budget_tokens 
+    and that hold at most max_items rows. Returns a list of batches of index labels. A row that 
+    exceeds the budget on its own gets a batch to itself.
+    """
+    batches, current_batch, current_tokens = [], [], 0
+    for index, num_tokens in token_counts.items():
+        if current_batch and (current_tokens + num_tokens > budget_tokens or len(current_batch) >= max_items):
+            batches.append(current_batch)
+            current_batch, current_tokens = [], 0
+        current_batch.append(index)
+        current_tokens += num_tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
 def chop_input(text: str, tokens_used: int, model_config: AzureOpenAIConfig):
     """
     Truncated the text if it exceeds max_tokens.
     """
-    enc = get_tokenizer(model_config.model)
+    enc = get_tokenizer(model_config)
     available_tokens = model_config.max_tokens - tokens_used
     text = enc.decode(enc.encode(text)[:available_tokens])
     return text
 
 
-def validate_total_tokens(df: pd.DataFrame, source_col: str, prompt: str, model_config: AzureOpenAIConfig):
+def validate_total_tokens(df: pd.DataFrame, source_col: str, prompt: str, model_config: AzureOpenAIConfig, 
+                          token_counts: pd.Series = None):
     """
     Validates that no item in the dataset exceeds the token limit.
+
+    Returns the per-item token counts (see get_token_counts) so callers can reuse them for cost 
+    estimation and batching. Pass token_counts to skip tokenizing the column again.
     """
     limit = min(model_config.tokens_per_minute_limit, model_config.max_input)
-    prompt_batch_all = [prompt + item for item in df[source_col]]  # Append prompt to all items in the column
-    for i, item in enumerate(prompt_batch_all):
-        total_tokens = estimate_num_tokens_from_str(item, model_config)
-        if total_tokens > limit:
-            raise ValueError(f"Total token limit exceeded for item {i} in the dataset: {total_tokens} tokens, which is greater than the per-minute limit of {limit} tokens.")
+    if token_counts is None:
+        token_counts = get_token_counts(df, source_col, model_config)
+    total_tokens = token_counts + estimate_num_tokens_from_str(prompt, model_config)  # Prompt is prepended to every item
+    exceeded = total_tokens[total_tokens > limit]
+    if not exceeded.empty:
+        raise ValueError(f"Total token limit exceeded for item {exceeded.index[0]} in the dataset: {exceeded.iloc[0]} tokens, which is greater than the per-minute limit of {limit} tokens.")
     print(f"All items in dataset passed validation.")
+    return token_counts
 
 
-def validate_total_tokens_batch(df: pd.DataFrame, source_col: str, prompt: str, model_config: AzureOpenAIConfig, batch_size: int):
+def validate_total_tokens_batch(df: pd.DataFrame, source_col: str, prompt: str, model_config: AzureOpenAIConfig, batch_size: int,
+                                token_counts: pd.Series = None):
     """
     Validates that the total number of tokens for the entire dataset does not exceed the set limit.
+
+    Returns the per-item token counts. Pass token_counts to skip tokenizing the column again.
     """
     limit = min(model_config.tokens_per_minute_limit, model_config.max_input)
-    prompt_batch_all = [prompt + item for item in df[source_col]]  # Append prompt to all items in the column
+    if token_counts is None:
+        token_counts = get_token_counts(df, source_col, model_config)
+    prompt_tokens = estimate_num_tokens_from_str(prompt, model_config)
+    item_tokens = token_counts.to_numpy() + prompt_tokens + 1  # Prompt is prepended to every item, items are joined by a space
 
     for i in range(0, len(df), batch_size):
-        data_batch = prompt_batch_all[i:i+batch_size]
-        joined_batch = ' '.join(data_batch)
-        total_tokens = estimate_num_tokens_from_str(joined_batch, model_config)
+        total_tokens = int(item_tokens[i:i+batch_size].sum())
         if total_tokens > limit:
             raise ValueError(f"Total token limit exceeded for the batch: {total_tokens} tokens, which is greater than the per-minute limit of {limit} tokens.")
         print(f"Total tokens in batch: {total_tokens} are within the allowed limit of {limit} tokens.")
     print('All batches passed validation.')
+    return token_counts
 
 
 
 ##################################################
-#    Requests functions w/ Exponential Backoff
+#    Rate limiting
 ##################################################
 
-@retry(wait=wait_exponential(multiplier=1, max=60), stop=stop_after_attempt(5))
-def get_completion_json(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig):
-    client = AzureOpenAI(
-        api_key=api_config.api_key,  
-        api_version=api_config.api_version,
-        azure_endpoint=api_config.endpoint
-    )
-    try:
-        response = client.chat.completions.create(
-                model=model_config.deployment,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=model_config.max_output,
-                stop=None,
-                n=1,
-                response_format= {
-                                "type": "json_object"
-                                }
-            )
-        return response
-    except BadRequestError as e:  # Specific handling for HTTP 400 error (ResponsibleAIPolicyViolation)
-        if e.status_code == 400:  # Check if the error is a 400
-            print(f"Error code 400 encountered: Bad Request - {e}")
+class RateLimiter:
+    """ Dual token-bucket limiter for the per-minute token and request quotas of a deployment.
+
+    Both buckets refill continuously at limit/60 per second and start full. A request may only
+    go out once both buckets can cover it, so callers block in acquire() until there is budget.
+    """
+    def __init__(self, tokens_per_minute_limit: int, requests_per_minute_limit: int) -> None:
+        self.token_capacity = tokens_per_minute_limit
+        self.request_capacity = requests_per_minute_limit
+        self.available_tokens = float(tokens_per_minute_limit)
+        self.available_requests = float(requests_per_minute_limit)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.available_tokens = min(self.token_capacity, self.available_tokens + elapsed * self.token_capacity / 60)
+        self.available_requests = min(self.request_capacity, self.available_requests + elapsed * self.request_capacity / 60)
+        self.last_refill = now
+
+    def acquire(self, num_tokens: int):
+        """
+        Blocks until one request and num_tokens tokens are available, then consumes them.
+        """
+        num_tokens = min(num_tokens, self.token_capacity)  # A single oversized request would otherwise wait forever
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available_tokens >= num_tokens and self.available_requests >= 1:
+                    self.available_tokens -= num_tokens
+                    self.available_requests -= 1
+                    return
+                token_wait = (num_tokens - self.available_tokens) * 60 / self.token_capacity
+                request_wait = (1 - self.available_requests) * 60 / self.request_capacity
+            time.sleep(max(token_wait, request_wait, 0.01))
+
+    def refund(self, num_tokens: int):
+        """
+        Returns unused tokens to the bucket, e.g. when a completion used fewer tokens than reserved.
+        """
+        with self.lock:
+            self._refill()
+            self.available_tokens = min(self.token_capacity, self.available_tokens + max(num_tokens, 0))
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model_config: AzureOpenAIConfig):
+    """
+    Returns the shared RateLimiter for a deployment so that concurrent jobs draw from the same quota.
+    """
+    with _rate_limiters_lock:
+        if model_config.deployment not in _rate_limiters:
+            _rate_limiters[model_config.deployment] = RateLimiter(model_config.tokens_per_minute_limit, 
+                                                                  model_config.requests_per_minute_limit)
+        return _rate_limiters[model_config.deployment]
+
+
+class RateController:
+    """ Coordinates retries across all workers sending requests to one deployment.
+
+    When Azure answers with a 429, every worker is paused until the 'retry-after' time has passed
+    (instead of each retry backing off on its own and retrying at the same time as the others),
+    and the allowed concurrency is halved. Every successful response raises it again by about one
+    request per round trip (additive increase, multiplicative decrease). A pause is also started
+    when the 'x-ratelimit-remaining-*' headers report an exhausted quota.
+
+    Attributes:
+        concurrency_limit (float): Number of requests currently allowed in flight.
+        retries (int): Attempts that were retried (including 429s).
+        rate_limited (int): Attempts rejected with a 429.
+        failures (int): Requests that failed after all attempts or with a non-retryable error.
+    """
+    def __init__(self, max_concurrency: int = 64, min_concurrency: int = 1, default_pause: float = 1.0) -> None:
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.default_pause = default_pause
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Blocks while requests are paused or the concurrency limit is reached."""
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < int(self.concurrency_limit):
+                    self.in_flight += 1
+                    return
+                self.condition.wait(timeout=pause if pause > 0 else None)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, headers):
+        with self.condition:
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+            if self._quota_exhausted(headers):
+                self._pause(self._get_retry_after(headers))
+            self.condition.notify_all()
+
+    def on_rate_limited(self, headers):
+        with self.condition:
+            self.rate_limited += 1
+            self.retries += 1
+            if time.monotonic() >= self.paused_until:  # Only back off once per pause, not once per rejected worker
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+            self._pause(self._get_retry_after(headers))
+
+    def on_retry(self):
+        with self.condition:
+            self.retries += 1
+
+    def on_failure(self):
+        with self.condition:
+            self.failures += 1
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {"concurrency_limit": self.concurrency_limit, "in_flight": self.in_flight, 
+                    "retries": self.retries, "rate_limited": self.rate_limited, "failures": self.failures}
+
+    def _pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _get_retry_after(self, headers):
+        if headers is not None:
+            try:
+                if headers.get('retry-after-ms') is not None:
+                    return float(headers['retry-after-ms']) / 1000
+                if headers.get('retry-after') is not None:
+                    return float(headers['retry-after'])
+            except ValueError:
+                pass  # HTTP-date formatted retry-after
+        return self.default_pause
+
+    @staticmethod
+    def _quota_exhausted(headers):
+        if headers is None:
             return False
-        else:
-            print(f"An error occurred: {e}")
-            raise  # Reraise other HTTP errors
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        raise
-
-
-@retry(wait=wait_exponential(multiplier=1, max=60), stop=stop_after_attempt(15))
-def get_completion_string(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig):
-    client = AzureOpenAI(
-        api_key=api_config.api_key,  
-        api_version=api_config.api_version,
-        azure_endpoint=api_config.endpoint
-    )
-    try:
-        response = client.chat.completions.create(
-                model=model_config.deployment,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=model_config.max_output,
-                stop=None,
-                n=1
+        for header in ('x-ratelimit-remaining-requests', 'x-ratelimit-remaining-tokens'):
+            try:
+                if headers.get(header) is not None and float(headers[header]) <= 0:
+                    return True
+            except ValueError:
+                continue
+        return False
+
+
+_rate_controllers = {}
+
+def get_rate_controller(model_config: AzureOpenAIConfig):
+    """
+    Returns the shared RateController for a deployment.
+    """
+    with _rate_limiters_lock:
+        if model_config.deployment not in _rate_controllers:
+            _rate_controllers[model_config.deployment] = RateController()
+        return _rate_controllers[model_config.deployment]
+
+
+##################################################
+#    Requests functions w/ Adaptive Backoff
+##################################################
+
+def _send_with_backoff(send_request, model_config: AzureOpenAIConfig, max_attempts: int, prompt: str = None, 
+                       stream: bool = False):
+    """
+    Calls send_request() (which must return a raw API response) up to max_attempts times and 
+    returns the parsed response. 429s pause every worker of the deployment through its 
+    RateController; other errors back off exponentially (max 60 sec). Returns False if the 
+    request is rejected with a 400 (e.g. ResponsibleAIPolicyViolation).
+
+    Every call is recorded in the telemetry registry. prompt is only used to estimate the 
+    billed input tokens of requests rejected with a 400.
+
+    If stream is True, the request's slot in the RateController is kept and a (stream, attempt_start, 
+    call_start, retries, time_to_first_byte) tuple is returned instead. The caller must release the 
+    slot and record the call once the stream is consumed, since usage is only known at its end.
+    """
+    controller = get_rate_controller(model_config)
+    registry = get_registry()
+    call_start = time.perf_counter()
+    retries = 0
+    for attempt in range(1, max_attempts + 1):
+        controller.acquire()
+        attempt_start = time.perf_counter()
+        backoff = None
+        streaming = False
+        try:
+            raw_response = send_request()
+            controller.on_success(raw_response.headers)
+            response = raw_response.parse()
+            if stream:
+                streaming = True
+                return response, attempt_start, call_start, retries, _get_time_to_first_byte(raw_response)
+            usage = response.usage
+            completion_tokens = getattr(usage, 'completion_tokens', 0) or 0  # Embeddings have no completion tokens
+            registry.record(CallRecord(
+                model_config.deployment, 'ok', usage.prompt_tokens, completion_tokens,
+                cost=(usage.prompt_tokens/1000) * model_config.input_cost + (completion_tokens/1000) * model_config.output_cost,
+                latency=time.perf_counter() - attempt_start, time_to_first_byte=_get_time_to_first_byte(raw_response),
+                wait_time=attempt_start - call_start, retries=retries, tokens_per_minute_limit=model_config.tokens_per_minute_limit))
+            return response
+        except RateLimitError as e:
+            print(f"Rate limit reached (attempt {attempt}/{max_attempts}): {e}")
+            if attempt == max_attempts:
+                controller.on_failure()
+                _record_failure(model_config, 'error', attempt_start, call_start, retries)
+                raise
+            controller.on_rate_limited(e.response.headers)
+            retries += 1
+        except BadRequestError as e:  # Specific handling for HTTP 400 error (ResponsibleAIPolicyViolation)
+            if e.status_code == 400:  # Check if the error is a 400
+                print(f"Error code 400 encountered: Bad Request - {e}")
+                prompt_tokens = estimate_num_tokens_from_str(prompt, model_config) if prompt is not None else 0
+                _record_failure(model_config, 'content_filter', attempt_start, call_start, retries, prompt_tokens)
+                return False
+            else:
+                print(f"An error occurred: {e}")
+                controller.on_failure()
+                _record_failure(model_config, 'error', attempt_start, call_start, retries)
+                raise  # Reraise other HTTP errors
+        except Exception as e:
+            print(f"An error occurred (attempt {attempt}/{max_attempts}): {e}")
+            if attempt == max_attempts:
+                controller.on_failure()
+                _record_failure(model_config, 'error', attempt_start, call_start, retries)
+                raise
+            controller.on_retry()
+            retries += 1
+            backoff = min(60, 2 ** attempt) * random.uniform(0.5, 1)
+        finally:
+            if not streaming:
+                controller.release()
+        if backoff:
+            time.sleep(backoff)
+
+
+def _record_failure(model_config: AzureOpenAIConfig, outcome: str, attempt_start: float, call_start: float, 
+                    retries: int, prompt_tokens: int = 0):
+    get_registry().record(CallRecord(
+        model_config.deployment, outcome, prompt_tokens, cost=(prompt_tokens/1000) * model_config.input_cost,
+        latency=time.perf_counter() - attempt_start, wait_time=attempt_start - call_start, retries=retries,
+        tokens_per_minute_limit=model_config.tokens_per_minute_limit))
+
+
+def _request_completion(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, 
+                        max_attempts: int, **params):
+    client = get_client(api_config)
+    return _send_with_backoff(lambda: client.chat.completions.with_raw_response.create(
+                                    model=model_config.deployment,
+                                    messages=[{"role": "user", "content": prompt}],
+                                    max_tokens=model_config.max_output,
+                                    stop=None,
+                                    n=1,
+                                    **params
+                                ), model_config, max_attempts, prompt)
+
+
+def _request_completion_json(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig):
+    return _request_completion(prompt, model_config, api_config, max_attempts=5, 
+                               response_format={"type": "json_object"})
+
+
+def _request_completion_string(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig):
+    return _request_completion(prompt, model_config, api_config, max_attempts=15)
+
+
+def _get_completion(request_func, params: dict, prompt: str, model_config: AzureOpenAIConfig, 
+                    api_config: AzureAPIConfig, use_cache: bool, rate_limiter: RateLimiter, num_prompt_tokens: int = None):
+    """
+    Serves the prompt from the completion cache if possible, otherwise waits for quota (when a 
+    rate limiter is given), sends the request and caches successful responses.
+    """
+    cache = get_default_cache() if use_cache else None
+    if cache is not None:
+        key = CompletionCache.make_key(model_config.deployment, prompt, params)
+        cached_response = cache.get(key)
+        if cached_response is not None:
+            response = ChatCompletion.model_validate_json(cached_response)
+            response.usage = CompletionUsage(prompt_tokens=0, completion_tokens=0, total_tokens=0)  # Cache hits are free
+            get_registry().record(CallRecord(model_config.deployment, 'cache_hit', 
+                                             tokens_per_minute_limit=model_config.tokens_per_minute_limit))
+            return response
+
+    if rate_limiter is not None:
+        if num_prompt_tokens is None:
+            num_prompt_tokens = estimate_num_tokens_from_str(prompt, model_config)
+        reserved_tokens = num_prompt_tokens + model_config.max_output
+        wait_start = time.perf_counter()
+        rate_limiter.acquire(reserved_tokens)
+        get_registry().observe_quota_wait(model_config.deployment, time.perf_counter() - wait_start)
+    response = request_func(prompt, model_config, api_config)
+    if rate_limiter is not None and response:
+        rate_limiter.refund(reserved_tokens - response.usage.total_tokens)
+
+    if cache is not None and response:
+        cache.put(key, model_config.deployment, response.model_dump_json())
+    return response
+
+
+def _get_json_params(model_config: AzureOpenAIConfig):
+    """Generation parameters of get_completion_json, as used in its cache keys."""
+    return {"max_tokens": model_config.max_output, "response_format": "json_object"}
+
+
+def get_completion_json(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, 
+                        use_cache: bool = True, rate_limiter: RateLimiter = None, num_prompt_tokens: int = None):
+    """
+    Returns a JSON-mode chat completion for the prompt, or False if the request was rejected 
+    with a 400. Set use_cache=False to bypass the on-disk completion cache. num_prompt_tokens
+    (if already known) is only used to reserve quota from the rate limiter.
+    """
+    return _get_completion(_request_completion_json, _get_json_params(model_config), prompt, model_config, api_config, use_cache, rate_limiter, num_prompt_tokens)
+
+
+def get_completion_string(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, 
+                          use_cache: bool = True, rate_limiter: RateLimiter = None, num_prompt_tokens: int = None):
+    """
+    Returns a plain-text chat completion for the prompt, or False if the request was rejected 
+    with a 400. Set use_cache=False to bypass the on-disk completion cache. num_prompt_tokens
+    (if already known) is only used to reserve quota from the rate limiter.
+    """
+    params = {"max_tokens": model_config.max_output, "response_format": "text"}
+    return _get_completion(_request_completion_string, params, prompt, model_config, api_config, use_cache, rate_limiter, num_prompt_tokens)
+
+
+
+STREAM_USAGE_API_VERSION = "2024-09-01"  # First API version that reports usage at the end of a stream
+
+
+class CompletionStream:
+    """ Streams a chat completion, yielding the generated text as it arrives.
+
+    Iterating over the stream sends the request (or reads it from the completion cache, in which 
+    case the whole answer is yielded at once) and yields every content delta. Quota is reserved 
+    from the rate limiter and the RateController slot is held until the stream ends, and retries 
+    only happen before the first delta is received. Once the stream is exhausted, content, 
+    response (an assembled ChatCompletion, which is also cached), usage and cost are set and the 
+    call is recorded in the telemetry registry. If the iteration is stopped early, the call is 
+    recorded as 'cancelled' with the tokens generated so far. With API versions older than 
+    STREAM_USAGE_API_VERSION the completion tokens are estimated with the tokenizer.
+
+    Attributes:
+        content (str): Text received so far.
+        response (ChatCompletion): Full response once the stream has finished, or False if the request was rejected with a 400.
+        usage (CompletionUsage): Token usage reported at the end of the stream (estimated if the API did not send it).
+        cost (float): Cost of the call in dollars.
+    """
+    def __init__(self, prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, json_mode: bool = False, 
+                 use_cache: bool = True, rate_limiter: RateLimiter = None, num_prompt_tokens: int = None):
+        self.prompt = prompt
+        self.model_config = model_config
+        self.api_config = api_config
+        self.json_mode = json_mode
+        self.use_cache = use_cache
+        self.rate_limiter = rate_limiter
+        self.num_prompt_tokens = num_prompt_tokens
+        self.content = ""
+        self.response = None
+        self.usage = None
+        self.cost = 0.0
+
+    def __iter__(self):
+        model_config = self.model_config
+        params = {"max_tokens": model_config.max_output, "response_format": "json_object" if self.json_mode else "text"}  # Same cache key as get_completion_json/string
+        cache = get_default_cache() if self.use_cache else None
+        if cache is not None:
+            key = CompletionCache.make_key(model_config.deployment, self.prompt, params)
+            cached_response = cache.get(key)
+            if cached_response is not None:
+                self.response = ChatCompletion.model_validate_json(cached_response)
+                self.response.usage = self.usage = CompletionUsage(prompt_tokens=0, completion_tokens=0, total_tokens=0)  # Cache hits are free
+                self.content = self.response.choices[0].message.content or ""
+                get_registry().record(CallRecord(model_config.deployment, 'cache_hit', 
+                                                 tokens_per_minute_limit=model_config.tokens_per_minute_limit))
+                if self.content:
+                    yield self.content
+                return
+
+        if self.num_prompt_tokens is None:
+            self.num_prompt_tokens = estimate_num_tokens_from_str(self.prompt, model_config)
+        reserved_tokens = self.num_prompt_tokens + model_config.max_output
+        if self.rate_limiter is not None:
+            wait_start = time.perf_counter()
+            self.rate_limiter.acquire(reserved_tokens)
+            get_registry().observe_quota_wait(model_config.deployment, time.perf_counter() - wait_start)
+
+        client = get_client(self.api_config)
+        extra_params = {"response_format": {"type": "json_object"}} if self.json_mode else {}
+        if self.api_config.api_version[:10] >= STREAM_USAGE_API_VERSION:  # Older versions reject stream_options
+            extra_params["stream_options"] = {"include_usage": True}  # Usage is sent in a final chunk
+        result = _send_with_backoff(lambda: client.chat.completions.with_raw_response.create(
+                                        model=model_config.deployment,
+                                        messages=[{"role": "user", "content": self.prompt}],
+                                        max_tokens=model_config.max_output,
+                                        stop=None,
+                                        n=1,
+                                        stream=True,
+                                        **extra_params
+                                    ), model_config, 5 if self.json_mode else 15, self.prompt, stream=True)
+        if not result:
+            self.response = False
+            return
+        stream, attempt_start, call_start, retries, time_to_first_byte = result
+
+        parts = []
+        last_chunk = None
+        finish_reason = None
+        time_to_first_token = None
+        outcome = 'cancelled'
+        try:
+            for chunk in stream:
+                last_chunk = chunk
+                if chunk.usage is not None:
+                    self.usage = chunk.usage
+                for choice in chunk.choices:  # The first chunk from Azure can have no choices (prompt filter results)
+                    finish_reason = choice.finish_reason or finish_reason
+                    delta = choice.delta.content if choice.delta is not None else None
+                    if delta:
+                        if time_to_first_token is None:
+                            time_to_first_token = time.perf_counter() - attempt_start
+                        parts.append(delta)
+                        self.content = "".join(parts)
+                        yield delta
+            outcome = 'ok'
+        except Exception as e:
+            print(f"An error occurred while streaming: {e}")
+            outcome = 'error'
+            get_rate_controller(model_config).on_failure()
+            raise
+        finally:
+            get_rate_controller(model_config).release()
+            stream.close()
+            self._finish(outcome, last_chunk, finish_reason, attempt_start, call_start, retries, 
+                         time_to_first_byte, time_to_first_token, reserved_tokens)
+
+        if cache is not None and self.response:
+            cache.put(key, model_config.deployment, self.response.model_dump_json())
+
+    def _finish(self, outcome, last_chunk, finish_reason, attempt_start, call_start, retries, 
+                time_to_first_byte, time_to_first_token, reserved_tokens):
+        model_config = self.model_config
+        if self.usage is None:  # Stream was cut short, or the API version does not support include_usage
+            completion_tokens = estimate_num_tokens_from_str(self.content, model_config) if self.content else 0
+            self.usage = CompletionUsage(prompt_tokens=self.num_prompt_tokens, completion_tokens=completion_tokens, 
+                                         total_tokens=self.num_prompt_tokens + completion_tokens)
+        self.cost = get_cost(self.usage, model_config)
+        if self.rate_limiter is not None:
+            self.rate_limiter.refund(reserved_tokens - self.usage.total_tokens)
+
+        if outcome == 'ok':
+            self.response = ChatCompletion(
+                id=last_chunk.id if last_chunk is not None else "",
+                object="chat.completion",
+                created=last_chunk.created if last_chunk is not None else int(time.time()),
+                model=(last_chunk.model if last_chunk is not None else None) or model_config.deployment,
+                choices=[Choice(index=0, finish_reason=finish_reason or "stop", 
+                                message=ChatCompletionMessage(role="assistant", content=self.content))],
+                usage=self.usage
             )
-        return response
-    except BadRequestError as e:  # Specific handling for HTTP 400 error (ResponsibleAIPolicyViolation)
-        if e.status_code == 400:  # Check if the error is a 400
-            print(f"Error code 400 encountered: Bad Request - {e}")
-            return False
-        else:
-            print(f"An error occurred: {e}")
-            raise  # Reraise other HTTP errors
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        raise
-
-
-# @retry(wait=wait_exponential(multiplier=1, max=60), stop=stop_after_attempt(5))
-# def get_completion_string_batch(prompt_batch, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig):
-#     client = AzureOpenAI(
-#         api_key=api_config.api_key,  
-#         api_version=api_config.api_version,
-#         azure_endpoint=api_config.endpoint
-#     )
-#     try:
-#         response = client.chat.completions.create(
-#                 model=model_config.deployment,
-#                 messages=[{"role": "user", "content": prompt_batch}],
-#                 max_tokens=model_config.max_output,
-#                 stop=None,
-#                 n=1,
-#                 temperature=0
-#             )
-#         return response.choices
-#     except Exception as e:
-#         print(f"An error occurred: {e}")
-#         raise
+        get_registry().record(CallRecord(
+            model_config.deployment, outcome, self.usage.prompt_tokens, self.usage.completion_tokens, cost=self.cost,
+            latency=time.perf_counter() - attempt_start, time_to_first_byte=time_to_first_byte, 
+            time_to_first_token=time_to_first_token, wait_time=attempt_start - call_start, retries=retries, 
+            tokens_per_minute_limit=model_config.tokens_per_minute_limit))
+
+
+def stream_completion_string(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, 
+                             use_cache: bool = True, rate_limiter: RateLimiter = None, num_prompt_tokens: int = None):
+    """
+    Streaming version of get_completion_string. Returns a CompletionStream; iterate over it to 
+    receive the answer in pieces, then read its response, usage and cost.
+
+    Example:
+        stream = stream_completion_string(prompt, model_config, api_config)
+        for delta in stream:
+            print(delta, end="", flush=True)
+        print(f"\nCost: ${stream.cost:.4f}")
+    """
+    return CompletionStream(prompt, model_config, api_config, False, use_cache, rate_limiter, num_prompt_tokens)
+
+
+def stream_completion_json(prompt: str, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, 
+                           use_cache: bool = True, rate_limiter: RateLimiter = None, num_prompt_tokens: int = None):
+    """
+    Streaming version of get_completion_json. The deltas are pieces of the JSON text, so the 
+    answer can only be parsed once the stream has finished (from stream.content).
+    """
+    return CompletionStream(prompt, model_config, api_config, True, use_cache, rate_limiter, num_prompt_tokens)
+
+BATCH_INSTRUCTIONS = (
+    "\n\nApply the instructions above to each item below separately. Each item starts on a new line "
+    "with its id in square brackets. Respond with a JSON object mapping every item id to your answer "
+    "for that item, e.g. {\"0\": \"<answer>\", \"1\": \"<answer>\"}.\n\n"
+)
+BATCH_ITEM_OVERHEAD_TOKENS = 8  # "[id] " prefix and newline added to every item in a batch prompt
+BATCH_ANSWER_OVERHEAD_TOKENS = 6  # "id": "..", around every answer
+BATCH_PILOT_ITEMS = 4  # Rows in the first batch, whose answers are measured to size the other batches
+BATCH_DEFAULT_ANSWER_TOKENS = 20  # Assumed answer length (wrapping included) when the pilot batch gives nothing to measure
+BATCH_OUTPUT_MARGIN = 0.8  # Share of max_output the measured answers are allowed to fill
+
+
+def build_batch_prompt(prompt: str, items: list):
+    """
+    Builds a single prompt asking for one answer per item. items is a list of (item id, text) pairs.
+    """
+    return prompt + BATCH_INSTRUCTIONS + "\n".join(f"[{item_id}] {text}" for item_id, text in items)
+
+
+def parse_batch_response(response, item_ids: list):
+    """
+    Splits a batch response back into answers. Returns a dict of item id -> answer containing only 
+    the items that received a well-formed answer; missing or unknown ids are dropped.
+    """
+    if not response:
+        return {}
+    try:
+        results = json.loads(response.choices[0].message.content)
+    except (json.JSONDecodeError, TypeError):
+        return {}
+    if not isinstance(results, dict):
+        return {}
+
+    expected_ids = set(item_ids)
+    answers = {}
+    for item_id, answer in results.items():
+        item_id = int(item_id) if item_id.isdigit() else item_id
+        if item_id not in expected_ids or answer is None or isinstance(answer, (dict, list)):
+            continue
+        answers[item_id] = str(answer)
+    return answers
+
+
+JSON_SCHEMA_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", list: "list"}
+
+
+def build_json_schema_instructions(schema: dict):
+    """
+    Describes the expected JSON object (column name -> Python type) so it can be appended to a prompt.
+    """
+    fields = ", ".join(f'"{key}" ({JSON_SCHEMA_TYPES[value_type]})' for key, value_type in schema.items())
+    return f"\n\nRespond with a JSON object containing exactly these keys: {fields}.\n\n"
+
+
+def _coerce_json_value(value, value_type):
+    """Returns value converted to value_type, or raises ValueError if it does not fit the schema."""
+    if value is None:
+        raise ValueError("missing value")
+    if value_type is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in ("true", "false", "yes", "no"):
+            return value.strip().lower() in ("true", "yes")
+        raise ValueError(f"not a boolean: {value!r}")
+    if value_type is list:
+        if isinstance(value, list):
+            return value
+        raise ValueError(f"not a list: {value!r}")
+    if value_type in (int, float):
+        if isinstance(value, bool):
+            raise ValueError(f"not a number: {value!r}")
+        number = float(value)
+        if value_type is int:
+            if not number.is_integer():
+                raise ValueError(f"not an integer: {value!r}")
+            return int(number)
+        return number
+    if isinstance(value, (dict, list)):
+        raise ValueError(f"not a string: {value!r}")
+    return str(value)
+
+
+def parse_json_responses(contents: pd.Series, schema: dict):
+    """
+    Parses a Series of JSON response strings into one typed column per schema key.
+
+    Returns a DataFrame indexed like contents with the parsed columns, and the index of the rows 
+    whose content was not valid JSON or did not match the schema (those rows are left empty).
+    """
+    records, invalid = [], []
+    for index, content in contents.items():
+        try:
+            parsed = json_loads(content)
+            if not isinstance(parsed, dict):
+                raise ValueError("not a JSON object")
+            records.append({key: _coerce_json_value(parsed.get(key), value_type) for key, value_type in schema.items()})
+        except (ValueError, TypeError):  # orjson.JSONDecodeError and json.JSONDecodeError are ValueErrors
+            records.append({})
+            invalid.append(index)
+    parsed_df = pd.DataFrame(records, index=contents.index, columns=list(schema))
+    for key, value_type in schema.items():
+        if value_type is int:
+            parsed_df[key] = parsed_df[key].astype('Int64')
+        elif value_type is float:
+            parsed_df[key] = parsed_df[key].astype('float64')
+        elif value_type is bool:
+            parsed_df[key] = parsed_df[key].astype('boolean')
+    return parsed_df, pd.Index(invalid)
+
+
+def _request_embeddings(texts: list, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, max_attempts: int = 15):
+    client = get_client(api_config)
+    return _send_with_backoff(lambda: client.embeddings.with_raw_response.create(
+                                    model=model_config.deployment,
+                                    input=texts
+                                ), model_config, max_attempts)
 
 
 ##################################################
@@ -265,7 +959,7 @@ def get_completion_string(prompt: str, model_config: AzureOpenAIConfig, api_conf
 ##################################################
 
 def add_filter_column(df: pd.DataFrame, source_col: str, target_col: str, prompt: str, 
-                      model_config: AzureOpenAIConfig, api_config: AzureAPIConfig):
+                      model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, use_cache: bool = True):
     """ Use GPT to extract features from a column in a dataframe.
 
     Params:
@@ -275,8 +969,10 @@ def add_filter_column(df: pd.DataFrame, source_col: str, target_col: str, prompt
     prompt: Prompt to pass into completions API
     model_config: Azure openAI model configuration
     api_configuration: Azure openAI API configuration
+    use_cache: If False, bypass the on-disk completion cache
     """
-    validate_total_tokens(df, source_col, prompt, model_config)  # Perform token validation over the entire dataset
+    token_counts = validate_total_tokens(df, source_col, prompt, model_config)  # Perform token validation over the entire dataset
+    prompt_tokens = estimate_num_tokens_from_str(prompt, model_config)
 
     total_items_processed = 0
     total_api_cost = 0.0
@@ -288,13 +984,9 @@ def add_filter_column(df: pd.DataFrame, source_col: str, target_col: str, prompt
             datapoint = df[source_col][i]
             current_prompt = prompt + datapoint
 
-            response = get_completion_string(current_prompt, model_config, api_config)
-            if response:
-                result_df.loc[i, target_col] = response.choices[0].message.content 
-                total_api_cost += get_cost(response.usage, model_config)
-            else:
-                result_df.loc[i, target_col] = response
-                total_api_cost += (estimate_num_tokens_from_str(current_prompt, model_config)/1000 * model_config.input_cost)
+            response = get_completion_string(current_prompt, model_config, api_config, use_cache=use_cache)
+            result_df.loc[i, target_col] = response.choices[0].message.content if response else response
+            total_api_cost += get_response_cost(response, current_prompt, model_config, prompt_tokens + token_counts.iloc[i])
 
             total_items_processed += 1
 
@@ -306,86 +998,379 @@ def add_filter_column(df: pd.DataFrame, source_col: str, target_col: str, prompt
     return result_df
 
 
-# def add_json_filter_columns(df: pd.DataFrame, source_col: str, target_col: list[str], prompt: str, 
-#                       model_config: AzureOpenAIConfig, api_config: AzureAPIConfig):
-#     """ Use GPT to extract features from a column in a dataframe.
-
-#     Params:
-#     df: Dataframe to add column to
-#     source_col: Name of column containing source data
-#     target_col: Name of new column to be created
-#     prompt: Prompt to pass into completions API
-#     model_config: Azure openAI model configuration
-#     api_configuration: Azure openAI API configuration
-#     """
-#     validate_total_tokens(df, source_col, prompt, model_config)  # Perform token validation over the entire dataset
-
-#     total_items_processed = 0
-#     total_api_cost = 0.0
-#     result_df = df.copy(deep=True)
-#     for col in target_col:
-#         result_df.loc[:, col] = ''  # Creating empty columns to store results
-
-#     for i in range(0, len(df)):
-#         try:
-#             datapoint = df[source_col][i]
-#             current_prompt = prompt + datapoint
-
-#             response = get_completion_json(current_prompt, model_config, api_config)
-#             if response:
-#                 response_json = response.choices[0].message.content 
-#                 result_df.loc[i, target_col] = 
-#                 total_api_cost += get_cost(response.usage, model_config)
-#             else:
-#                 result_df.loc[i, target_col] = response
-#                 total_api_cost += (estimate_num_tokens_from_str(current_prompt, model_config)/1000 * model_config.input_cost)
-
-#             total_items_processed += 1
-
-#             print(f"Total processed so far: {total_items_processed}/{len(df)}, Cost so far: ${total_api_cost:.2f}")
-
-#         except Exception as e:
-#             print(f"Error processing item at index {i}: {e}")
-#             return result_df
-#     return result_df
-
-
-# def add_filter_column_batch(df: pd.DataFrame, source_col: str, target_col: str, prompt: str, 
-#                       model_config: AzureOpenAIConfig, api_config: AzureAPIConfig,
-#                       batch_size=10):
-#     """ Use GPT to extract features from a column in a dataframe.
-
-#     Params:
-#     df: Dataframe to add column to
-#     source_col: Name of column containing source data
-#     target_col: Name of new column to be created
-#     prompt: Prompt to pass into completions API
-#     model_config: Azure openAI model configuration
-#     api_configuration: Azure openAI API configuration
-#     batch_size: number of calls sent in parallel
-#     """
-#     validate_total_tokens_batch(df, source_col, prompt, model_config, batch_size)  # Perform token validation over the entire dataset
-
-#     total_items_processed = 0
-#     total_api_cost = 0.0
-#     result_df = df[[source_col]]
-#     result_df.loc[:, target_col] = ''  # Creating empty column to store result
-
-#     for i in range(0, len(df), batch_size):
-#         data_batch = df[source_col][i:i+batch_size]
-#         prompt_batch = [prompt + item for item in data_batch]  # Send entire batch in same call
-
-#         try:
-#             batch_response = get_completion_string_batch(prompt_batch, model_config, api_config)
-
-#             for response in batch_response.choices:
-#                 result_df.loc[i + response.index, target_col] = response.message.content  # Match completions response by index
-
-#             total_api_cost += get_cost(batch_response.usage, model_config)
-#             total_items_processed += len(batch_response.choices)
-
-#             print(f"Total processed so far: {total_items_processed}/{len(df)}, Cost so far: ${total_api_cost:.2f}")
-
-#         except Exception as e:
-#             print(f"Error processing batch starting at index {i}: {e}")
-#     return result_df
\ No newline at end of file
+def add_filter_column_concurrent(df: pd.DataFrame, source_col: str, target_col: str, prompt: str, 
+                                 model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, max_workers: int = 32, 
+                                 use_cache: bool = True):
+    """ Same as add_filter_column, but keeps up to max_workers requests in flight at once.
+
+    Requests are paced by the deployment's shared RateLimiter (tokens_per_minute_limit and 
+    requests_per_minute_limit), so the number of requests actually in flight is whatever the 
+    quota allows. Results are written back by row index as they complete.
+
+    Params:
+    df: Dataframe to add column to
+    source_col: Name of column containing source data
+    target_col: Name of new column to be created
+    prompt: Prompt to pass into completions API
+    model_config: Azure openAI model configuration
+    api_configuration: Azure openAI API configuration
+    max_workers: Max number of requests in flight at the same time
+    use_cache: If False, bypass the on-disk completion cache
+    """
+    token_counts = validate_total_tokens(df, source_col, prompt, model_config)  # Perform token validation over the entire dataset
+    prompt_tokens = estimate_num_tokens_from_str(prompt, model_config)
+
+    total_items_processed = 0
+    total_api_cost = 0.0
+    result_df = df.copy(deep=True)
+    result_df.loc[:, target_col] = ''  # Creating empty column to store result
+    rate_limiter = get_rate_limiter(model_config)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for index, datapoint in df[source_col].items():
+            current_prompt = prompt + datapoint
+            num_prompt_tokens = prompt_tokens + int(token_counts[index])
+            future = executor.submit(get_completion_string, current_prompt, model_config, api_config, 
+                                     use_cache=use_cache, rate_limiter=rate_limiter, num_prompt_tokens=num_prompt_tokens)
+            futures[future] = (index, current_prompt, num_prompt_tokens)
+
+        for future in as_completed(futures):
+            index, current_prompt, num_prompt_tokens = futures[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"Error processing item at index {index}: {e}")
+                for pending in futures:
+                    pending.cancel()
+                return result_df
+
+            result_df.loc[index, target_col] = response.choices[0].message.content if response else response
+            total_api_cost += get_response_cost(response, current_prompt, model_config, num_prompt_tokens)
+            total_items_processed += 1
+
+            print(f"Total processed so far: {total_items_processed}/{len(df)}, Cost so far: ${total_api_cost:.2f}")
+    return result_df
+
+
+def add_json_filter_columns(df: pd.DataFrame, source_col: str, schema: dict, prompt: str, 
+                            model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, 
+                            max_workers: int = 32, max_reasks: int = 2, use_cache: bool = True):
+    """ Use GPT to extract several features from a column in a dataframe in a single pass.
+
+    Every row is sent once in JSON mode. Each response is parsed (with orjson when installed) and 
+    validated against the schema into one typed column per schema key; only the rows whose request 
+    raised or whose response fails validation are asked again (bypassing the cache), up to 
+    max_reasks times. Valid re-asked answers replace the invalid ones in the cache. Rows that still 
+    fail are left empty (NaN) and their indices are printed, and rows rejected with a 400 get False 
+    in every new column.
+
+    Params:
+    df: Dataframe to add columns to
+    source_col: Name of column containing source data
+    schema: Dict of new column name -> type (str, int, float, bool or list) expected in the JSON response
+    prompt: Prompt to pass into completions API. The expected keys and types are appended to it.
+    model_config: Azure openAI model configuration
+    api_configuration: Azure openAI API configuration
+    max_workers: Max number of requests in flight at the same time
+    max_reasks: Max number of times rows with failed or invalid responses are sent again
+    use_cache: If False, bypass the on-disk completion cache
+    """
+    unknown_types = [value_type for value_type in schema.values() if value_type not in JSON_SCHEMA_TYPES]
+    if unknown_types:
+        raise ValueError(f"Unsupported schema types: {unknown_types}. Use one of {list(JSON_SCHEMA_TYPES)}.")
+
+    prompt = prompt + build_json_schema_instructions(schema)
+    token_counts = validate_total_tokens(df, source_col, prompt, model_config)  # Perform token validation over the entire dataset
+    prompt_tokens = estimate_num_tokens_from_str(prompt, model_config)
+
+    total_api_cost = 0.0
+    contents = pd.Series(None, index=df.index, dtype=object)
+    rejected = []
+    rate_limiter = get_rate_limiter(model_config)
+    pending = list(df.index)
+    reasked = {}  # Index -> (prompt, response) of re-asked rows, cached once their answer validates
+    cache = get_default_cache() if use_cache else None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for attempt in range(max_reasks + 1):
+            if attempt > 0:
+                print(f"Re-asking {len(pending)} items with failed or invalid responses (attempt {attempt}/{max_reasks}).")
+            total_items_processed = 0
+            errored = []
+            futures = {}
+            for index in pending:
+                current_prompt = prompt + df.at[index, source_col]
+                num_prompt_tokens = prompt_tokens + int(token_counts[index])
+                future = executor.submit(get_completion_json, current_prompt, model_config, api_config, 
+                                         use_cache=use_cache and attempt == 0,  # A cached answer would be the same invalid one
+                                         rate_limiter=rate_limiter, num_prompt_tokens=num_prompt_tokens)
+                futures[future] = (index, current_prompt, num_prompt_tokens)
+
+            for future in as_completed(futures):
+                index, current_prompt, num_prompt_tokens = futures[future]
+                try:
+                    response = future.result()
+                except Exception as e:
+                    print(f"Error processing item at index {index}: {e}")
+                    errored.append(index)  # Asked again with the invalid responses
+                    continue
+
+                if response:
+                    contents[index] = response.choices[0].message.content
+                    if attempt > 0:
+                        reasked[index] = (current_prompt, response)
+                else:
+                    contents[index] = None
+                    rejected.append(index)
+                total_api_cost += get_response_cost(response, current_prompt, model_config, num_prompt_tokens)
+                total_items_processed += 1
+
+                print(f"Total processed so far: {total_items_processed}/{len(futures)}, Cost so far: ${total_api_cost:.2f}")
+
+            answered = contents.dropna()
+            parsed_df, invalid = parse_json_responses(answered, schema)
+            pending = list(invalid) + [index for index in errored if index not in invalid]
+
+            # Replace the cached invalid answers with the valid re-asked ones, so reruns do not re-ask them again
+            if cache is not None:
+                for index in [index for index in reasked if index not in invalid]:
+                    current_prompt, response = reasked.pop(index)
+                    key = CompletionCache.make_key(model_config.deployment, current_prompt, _get_json_params(model_config))
+                    cache.put(key, model_config.deployment, response.model_dump_json())
+            if not pending:
+                break
+
+    if pending:
+        print(f"{len(pending)} items still failed (request error or invalid response) and were left empty: {pending}")
+    result_df = df.copy(deep=True).join(parsed_df.drop(index=invalid).reindex(df.index))
+    if rejected:
+        for key in schema:
+            result_df[key] = result_df[key].astype(object)
+            result_df.loc[rejected, key] = False
+    return result_df
+
+
+def measure_batch_answer_tokens(response, num_answers: int, model_config: AzureOpenAIConfig):
+    """
+    Returns the output tokens used per answer by a batch response (JSON wrapping included), or None
+    if it has no answers. Counted from the text, so cached responses (which report no usage) work too.
+    """
+    if not response or num_answers == 0:
+        return None
+    return estimate_num_tokens_from_str(response.choices[0].message.content, model_config) / num_answers
+
+
+def add_filter_column_batch(df: pd.DataFrame, source_col: str, target_col: str, prompt: str, 
+                            model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, 
+                            max_items_per_request: int = 50, output_tokens_per_item: int = None,
+                            max_workers: int = 8, use_cache: bool = True):
+    """ Use GPT to extract features from a column in a dataframe, answering many rows per request.
+
+    Rows are packed into prompts up to the input token budget using precomputed token counts, and 
+    the model is asked for a JSON object of answers keyed by item id. Rows whose answer is missing or 
+    malformed (or whose batch was rejected) are retried on their own with get_completion_string.
+
+    The number of rows per request is bounded by how many answers fit in max_output. Unless 
+    output_tokens_per_item is given, a first batch of BATCH_PILOT_ITEMS rows is sent alone and its 
+    answers are measured to size the other batches. Batching only saves tokens when the prompt is 
+    long compared to the answers; check the cost per row of benchmark_llm_throughput.py first.
+
+    Params:
+    df: Dataframe to add column to
+    source_col: Name of column containing source data
+    target_col: Name of new column to be created
+    prompt: Prompt to pass into completions API
+    model_config: Azure openAI model configuration
+    api_configuration: Azure openAI API configuration
+    max_items_per_request: Max number of rows packed into a single request
+    output_tokens_per_item: Expected answer length. If None, it is measured on a first small batch.
+    max_workers: Max number of requests in flight at the same time
+    use_cache: If False, bypass the on-disk completion cache
+    """
+    token_counts = validate_total_tokens(df, source_col, prompt, model_config)  # Perform token validation over the entire dataset
+    single_prompt_tokens = estimate_num_tokens_from_str(prompt, model_config)
+    batch_prompt_tokens = estimate_num_tokens_from_str(prompt + BATCH_INSTRUCTIONS, model_config)
+    input_budget = min(model_config.max_input, model_config.tokens_per_minute_limit - model_config.max_output) - batch_prompt_tokens
+    item_tokens = token_counts + BATCH_ITEM_OVERHEAD_TOKENS
+
+    total_items_processed = 0
+    total_api_cost = 0.0
+    result_df = df.copy(deep=True)
+    result_df.loc[:, target_col] = ''  # Creating empty column to store result
+    rate_limiter = get_rate_limiter(model_config)
+    retry_indices = []
+
+    def send_batch(executor, batch):
+        items = [(item_id, df.at[index, source_col]) for item_id, index in enumerate(batch)]
+        batch_prompt = build_batch_prompt(prompt, items)
+        num_prompt_tokens = batch_prompt_tokens + int(item_tokens[batch].sum())
+        future = executor.submit(get_completion_json, batch_prompt, model_config, api_config,
+                                 use_cache=use_cache, rate_limiter=rate_limiter, num_prompt_tokens=num_prompt_tokens)
+        return future, (batch, batch_prompt, num_prompt_tokens)
+
+    def collect_batch(future, batch, batch_prompt, num_prompt_tokens):
+        """Writes the answers of a batch and queues its unanswered rows. Returns the response and the number of answers."""
+        nonlocal total_items_processed, total_api_cost
+        try:
+            response = future.result()
+        except Exception as e:
+            print(f"Error processing batch starting at index {batch[0]}: {e}")
+            retry_indices.extend(batch)
+            return None, 0
+
+        answers = parse_batch_response(response, list(range(len(batch))))
+        for item_id, index in enumerate(batch):
+            if item_id in answers:
+                result_df.loc[index, target_col] = answers[item_id]
+            else:
+                retry_indices.append(index)
+        total_api_cost += get_response_cost(response, batch_prompt, model_config, num_prompt_tokens)
+        total_items_processed += len(answers)
+
+        print(f"Total processed so far: {total_items_processed}/{len(df)}, Cost so far: ${total_api_cost:.2f}")
+        return response, len(answers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        remaining = item_tokens
+        answer_tokens = output_tokens_per_item + BATCH_ANSWER_OVERHEAD_TOKENS if output_tokens_per_item is not None else None
+        if answer_tokens is None and not item_tokens.empty:
+            pilot = pack_token_batches(item_tokens, input_budget, min(BATCH_PILOT_ITEMS, max_items_per_request))[0]
+            future, batch_info = send_batch(executor, pilot)
+            response, num_answers = collect_batch(future, *batch_info)
+            answer_tokens = measure_batch_answer_tokens(response, num_answers, model_config)
+            if answer_tokens is None:  # The pilot batch failed, its rows are retried on their own
+                answer_tokens = BATCH_DEFAULT_ANSWER_TOKENS
+                print(f"Could not measure the answer length, assuming {answer_tokens} output tokens per answer.")
+            else:
+                print(f"Measured about {answer_tokens:.0f} output tokens per answer.")
+            remaining = item_tokens.drop(index=pilot)
+
+        max_items = max(1, min(max_items_per_request, int(model_config.max_output * BATCH_OUTPUT_MARGIN / answer_tokens))) \
+                    if answer_tokens else max_items_per_request
+        batches = pack_token_batches(remaining, input_budget, max_items)
+        print(f"Packed {len(remaining)} items into {len(batches)} requests of up to {max_items} items.")
+
+        futures = dict(send_batch(executor, batch) for batch in batches)
+        for future in as_completed(futures):
+            collect_batch(future, *futures[future])
+
+        if retry_indices:
+            print(f"Retrying {len(retry_indices)} items individually.")
+        futures = {}
+        for index in retry_indices:
+            current_prompt = prompt + df.at[index, source_col]
+            num_prompt_tokens = single_prompt_tokens + int(token_counts[index])
+            future = executor.submit(get_completion_string, current_prompt, model_config, api_config, 
+                                     use_cache=use_cache, rate_limiter=rate_limiter, num_prompt_tokens=num_prompt_tokens)
+            futures[future] = (index, current_prompt, num_prompt_tokens)
+
+        for future in as_completed(futures):
+            index, current_prompt, num_prompt_tokens = futures[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"Error processing item at index {index}: {e}")
+                continue
+
+            result_df.loc[index, target_col] = response.choices[0].message.content if response else response
+            total_api_cost += get_response_cost(response, current_prompt, model_config, num_prompt_tokens)
+            total_items_processed += 1
+
+            print(f"Total processed so far: {total_items_processed}/{len(df)}, Cost so far: ${total_api_cost:.2f}")
+    return result_df
+
+
+def embed_column(df: pd.DataFrame, source_col: str, output_path: str, model_config: AzureOpenAIConfig, 
+                 api_config: AzureAPIConfig, max_workers: int = 8):
+    """ Embed every item of a column into a float32 matrix stored on disk.
+
+    Identical texts are embedded once (deduplicated by hash). The unique texts are packed into 
+    requests of up to max_array_size inputs and the token budget, which are sent concurrently under
+    the deployment's rate limiter. Vectors are written straight into a memory-mapped .npy file with
+    one row per DataFrame row, and the DataFrame index is saved to a '<name>_ids.json' sidecar.
+    Rows with empty or missing text (or whose request failed) are left as zero vectors. Requests are 
+    packed up to the model's max_input (EMBEDDING_MAX_INPUT_TOKENS for ada-002), and longer texts are 
+    truncated to it.
+
+    Params:
+    df: Dataframe containing the texts
+    source_col: Name of column containing source data
+    output_path: Path of the .npy matrix to write
+    model_config: Azure openAI embedding model configuration, e.g. get_default_model_config(2)
+    api_configuration: Azure openAI API configuration
+    max_workers: Max number of requests in flight at the same time
+
+    Returns:
+    The memory-mapped matrix (or None if there was nothing to embed) and the list of row ids.
+    """
+    texts = df[source_col].fillna('').astype(str).tolist()
+    unique_positions = {}  # Text hash -> position in unique_texts
+    unique_texts = []
+    row_to_unique = np.full(len(texts), -1, dtype=np.int64)
+    for row, text in enumerate(texts):
+        if not text.strip():
+            continue
+        text_hash = hashlib.sha1(text.encode('utf-8')).digest()
+        if text_hash not in unique_positions:
+            unique_positions[text_hash] = len(unique_texts)
+            unique_texts.append(text)
+        row_to_unique[row] = unique_positions[text_hash]
+    print(f"Embedding {len(unique_texts)} unique texts for {len(texts)} rows.")
+
+    token_counts = pd.Series(count_tokens_batch(unique_texts, model_config), dtype='int64')
+    budget = min(model_config.max_input, model_config.tokens_per_minute_limit)
+    too_long = token_counts.index[token_counts > budget]
+    if len(too_long):
+        print(f"Truncating {len(too_long)} texts longer than {budget} tokens.")
+        encoding = get_tokenizer(model_config)
+        for i in too_long:
+            unique_texts[i] = encoding.decode(encoding.encode(unique_texts[i])[:budget])
+        token_counts[too_long] = budget
+    batches = pack_token_batches(token_counts, budget, model_config.max_array_size or 1)
+    rows_by_unique = pd.Series(np.arange(len(texts))[row_to_unique >= 0]).groupby(row_to_unique[row_to_unique >= 0]).apply(list)
+
+    matrix = None
+    total_items_processed = 0
+    total_api_cost = 0.0
+    failed_rows = 0
+    rate_limiter = get_rate_limiter(model_config)
+
+    def embed_batch(batch):
+        wait_start = time.perf_counter()
+        rate_limiter.acquire(int(token_counts[batch].sum()))
+        get_registry().observe_quota_wait(model_config.deployment, time.perf_counter() - wait_start)
+        return _request_embeddings([unique_texts[i] for i in batch], model_config, api_config)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(embed_batch, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                response = future.result()
+                if not response:
+                    raise ValueError("Request was rejected with a 400.")
+            except Exception as e:
+                print(f"Error processing batch starting at unique text {batch[0]}: {e}")
+                failed_rows += sum(len(rows_by_unique[i]) for i in batch)
+                continue
+
+            if matrix is None:  # Vector size is only known once the first response arrives
+                dim = len(response.data[0].embedding)
+                matrix = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=(len(texts), dim))
+            for item in response.data:
+                matrix[rows_by_unique[batch[item.index]]] = np.asarray(item.embedding, dtype=np.float32)
+
+            total_api_cost += (response.usage.prompt_tokens/1000) * model_config.input_cost
+            total_items_processed += len(batch)
+            print(f"Total processed so far: {total_items_processed}/{len(unique_texts)}, Cost so far: ${total_api_cost:.2f}")
+
+    if matrix is not None:
+        matrix.flush()
+    if failed_rows:
+        print(f"{failed_rows} rows could not be embedded and were left as zero vectors.")
+
+    row_ids = df.index.tolist()
+    with open(os.path.splitext(output_path)[0] + '_ids.json', 'w') as file:
+        json.dump({"source_col": source_col, "model": model_config.model, "row_ids": row_ids}, file, default=str)
+    return matrix, row_ids
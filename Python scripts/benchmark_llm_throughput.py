@@ -0,0 +1,183 @@
+"""
+Offline throughput benchmark for the azure_openai_cookbook column functions.
+
+Runs add_filter_column and its concurrent and batched variants against the local stand-in server
+(fake_azure_openai_server.py) and reports rows/sec, achieved tokens per minute, retry overhead
+and cost per answered row for each mode. Batch mode is only worth using where its cost per row
+is lower than the concurrent mode's. The server simulates latency, 429s, content-filter errors
+and its own per-minute quota, so results are repeatable without spending real quota.
+
+To run this script, edit 'benchmark_llm_throughput_config.json' (or provide the path to a custom
+config file as an argument) and run 'python benchmark_llm_throughput.py'.
+"""
+
+import sys
+import os
+import json
+import time
+import pandas as pd
+from azure_openai_cookbook import (AzureAPIConfig, get_default_model_config, add_filter_column,
+                                   add_filter_column_concurrent, add_filter_column_batch)
+from fake_azure_openai_server import FakeServerConfig, start_fake_server
+from llm_telemetry import get_registry
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARK_PROMPT = "Does the following review mention the sound quality of the venue? Answer 'yes' or 'no'.\n\n"
+
+
+class Config:
+    """Loads in configuration settings for the benchmark.
+
+    Attributes:
+        source_path (str): JSON/CSV file with the texts to send. If empty, synthetic texts are used.
+        source_col (str): Column containing the texts.
+        n_rows (int): Number of rows to process in each mode.
+        modes (list): Any of 'sequential', 'concurrent' and 'batch'.
+        max_workers (int): Max number of requests in flight for the concurrent and batch modes.
+        output_path (str): Where to save the results as JSON. Empty to only print them.
+        model (dict): Overrides for the default model configuration.
+        server (dict): Settings for FakeServerConfig.
+    """
+    def __init__(self, config_path):
+        with open(config_path, 'r') as file:
+            config = json.load(file)
+
+        self.validate_config(config)
+
+        self.source_path = os.path.join(parent_dir, config['source_path']) if config.get('source_path') else None
+        self.source_col = config['source_col']
+        self.n_rows = config['n_rows']
+        self.modes = config['modes']
+        self.max_workers = config.get('max_workers', 16)
+        self.output_path = os.path.join(parent_dir, config['output_path']) if config.get('output_path') else None
+        self.model = config.get('model', {})
+        self.server = config.get('server', {})
+
+    @staticmethod
+    def validate_config(config):
+        """Validates required fields in the configuration."""
+        required_fields = ['source_col', 'n_rows', 'modes']
+        for field in required_fields:
+            if field not in config:
+                raise ValueError(f"Missing required config field: {field}")
+        unknown_modes = set(config['modes']) - {'sequential', 'concurrent', 'batch'}
+        if unknown_modes:
+            raise ValueError(f"Unknown benchmark modes: {unknown_modes}")
+
+
+def load_texts(config):
+    """Returns a DataFrame with n_rows texts in source_col (with a RangeIndex, as add_filter_column expects)."""
+    if config.source_path is None:
+        texts = [f"Review {i}: the sound was great but the drinks were expensive. " * (1 + i % 5) for i in range(config.n_rows)]
+        return pd.DataFrame({config.source_col: texts})
+    if config.source_path.endswith('.json'):
+        df = pd.read_json(config.source_path)
+    else:
+        df = pd.read_csv(config.source_path)
+    df = df[[config.source_col]].dropna()
+    df = pd.concat([df] * (config.n_rows // len(df) + 1)) if len(df) < config.n_rows else df  # Repeat small files
+    return df.head(config.n_rows).reset_index(drop=True)
+
+
+def get_model_config(config, deployment):
+    """Default model configuration with the benchmark overrides, under a fresh deployment name.
+
+    Each mode uses its own deployment name so that it starts with fresh rate limiter and rate
+    controller state.
+    """
+    model_config = get_default_model_config(0)
+    model_config.deployment = deployment
+    for key, value in config.model.items():
+        setattr(model_config, key, value)
+    model_config.max_input = model_config.max_tokens - model_config.max_output
+    return model_config
+
+
+def run_mode(mode, df, config):
+    """Runs one mode against a fresh fake server and returns its measurements."""
+    server = start_fake_server(FakeServerConfig(config.server))
+    api_config = AzureAPIConfig(api_key="fake-key", api_version="2024-02-15-preview", endpoint=server.endpoint)
+    deployment = f"benchmark-{mode}-{int(time.time())}"
+    model_config = get_model_config(config, deployment)
+    registry = get_registry()
+
+    print(f"\n[{mode.upper()}] Processing {len(df)} rows...")
+    start_time = time.time()
+    try:
+        if mode == 'sequential':
+            result_df = add_filter_column(df, config.source_col, 'answer', BENCHMARK_PROMPT, model_config, api_config, use_cache=False)
+        elif mode == 'concurrent':
+            result_df = add_filter_column_concurrent(df, config.source_col, 'answer', BENCHMARK_PROMPT, model_config, api_config,
+                                                     max_workers=config.max_workers, use_cache=False)
+        else:
+            result_df = add_filter_column_batch(df, config.source_col, 'answer', BENCHMARK_PROMPT, model_config, api_config,
+                                                max_workers=config.max_workers, use_cache=False)
+    finally:
+        server.shutdown()
+        server.server_close()
+    elapsed = time.time() - start_time
+
+    requests = sum(n for (d, _), n in registry.requests.items() if d == deployment)
+    tokens = registry.prompt_tokens[deployment] + registry.completion_tokens[deployment]
+    retry_wait = registry.wait_time[deployment].total
+    request_time = registry.latency[deployment].total
+    # Rows rejected with a 400 hold False, not an answer
+    rows_answered = int(result_df['answer'].map(lambda answer: isinstance(answer, str) and answer != '').sum())
+    return {
+        "mode": mode,
+        "rows": len(df),
+        "rows_answered": rows_answered,
+        "seconds": round(elapsed, 2),
+        "rows_per_sec": round(len(df) / elapsed, 2),
+        "requests": requests,
+        "server_requests": server.stats['requests'],
+        "achieved_tpm": round(tokens / elapsed * 60),
+        "tpm_limit": model_config.tokens_per_minute_limit,
+        "retries": registry.retries[deployment],
+        "rate_limited": server.stats['rate_limited'],
+        "retry_overhead": round(retry_wait / (retry_wait + request_time), 3) if retry_wait + request_time else 0.0,
+        "cost": round(registry.cost[deployment], 4),
+        "cost_per_row": round(registry.cost[deployment] / rows_answered, 6) if rows_answered else None
+    }
+
+
+def run_benchmark(config):
+    df = load_texts(config)
+    results = [run_mode(mode, df, config) for mode in config.modes]
+
+    print("\n" + pd.DataFrame(results).set_index('mode').to_string())
+    costed = [result for result in results if result['cost_per_row'] is not None]
+    if costed:
+        cheapest = min(costed, key=lambda result: result['cost_per_row'])
+        print(f"\nCheapest mode per answered row: {cheapest['mode']} (${cheapest['cost_per_row']:.6f}).")
+    if config.output_path:
+        os.makedirs(os.path.dirname(config.output_path), exist_ok=True)
+        with open(config.output_path, 'w') as file:
+            json.dump(results, file, indent=4)
+        print(f"\nResults saved to {config.output_path}")
+    return results
+
+
+def main(config_file):
+    try:
+        config = Config(config_file)
+        run_benchmark(config)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+    finally:
+        print("[✓] Execution complete.")
+
+
+if __name__ == "__main__":
+    # Default configuration file path
+    default_config_path = os.path.join(parent_dir, "Python scripts", "benchmark_llm_throughput_config.json")
+
+    # Check if the user has provided a custom config file
+    if len(sys.argv) >= 2:
+        config_file_path = sys.argv[1]
+    else:
+        print(f"No configuration file provided. Using default configuration: {default_config_path}")
+        config_file_path = default_config_path
+
+    main(config_file_path)
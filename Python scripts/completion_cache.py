@@ -0,0 +1,159 @@
+"""
+On-disk cache for Azure OpenAI chat completions.
+
+Responses are stored in a SQLite database keyed by deployment, a hash of the prompt and the
+generation parameters, so re-running a notebook or a crashed job only pays for prompts that
+have not succeeded before. Entries are evicted by age and, once the database grows past its
+size limit, least-recently-used first.
+
+The default cache lives at '.llm_cache/completions.sqlite' in the repo root and can be moved
+by setting the AZURE_OPENAI_CACHE_PATH environment variable.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class CompletionCache:
+    """Persistent prompt/response cache backed by SQLite.
+
+    Attributes:
+        path (str): Location of the SQLite database file.
+        max_size_bytes (int): Total size of stored responses before LRU eviction kicks in.
+        max_age_seconds (float): Entries older than this are discarded. None keeps entries forever.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that were not in the cache.
+    """
+    def __init__(self, path: str, max_size_bytes: int = 512 * 1024 * 1024, max_age_seconds: float = 30 * 24 * 3600,
+                 evict_every: int = 100):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_eviction = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                deployment TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_completions_last_access ON completions(last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(deployment: str, prompt: str, params: dict) -> str:
+        """Builds the cache key from the deployment, the prompt hash and the generation parameters."""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        params_str = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(f"{deployment}\x00{prompt_hash}\x00{params_str}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """Returns the stored response JSON string, or None on a miss or an expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None or self._is_expired(row[1], now):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, deployment: str, response: str):
+        """Stores a response JSON string, evicting old entries every evict_every writes."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, deployment, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, deployment, response, len(response), now, now))
+            self._conn.commit()
+            self._puts_since_eviction += 1
+            if self._puts_since_eviction >= self.evict_every:
+                self._evict(now)
+
+    def evict(self):
+        """Removes expired entries, then least-recently-used entries until under max_size_bytes."""
+        with self._lock:
+            self._evict(time.time())
+
+    def _evict(self, now):
+        self._puts_since_eviction = 0
+        if self.max_age_seconds is not None:
+            self._conn.execute("DELETE FROM completions WHERE created_at < ?", (now - self.max_age_seconds,))
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total_size > self.max_size_bytes:
+            excess = total_size - self.max_size_bytes
+            rows = self._conn.execute("SELECT key, size FROM completions ORDER BY last_access ASC")
+            stale_keys = []
+            for key, size in rows:
+                if excess <= 0:
+                    break
+                stale_keys.append((key,))
+                excess -= size
+            self._conn.executemany("DELETE FROM completions WHERE key = ?", stale_keys)
+        self._conn.commit()
+
+    def _is_expired(self, created_at, now):
+        return self.max_age_seconds is not None and created_at < now - self.max_age_seconds
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters along with the number and total size of stored entries."""
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size
+        }
+
+    def clear(self):
+        """Deletes every stored entry and resets the counters."""
+        with self._lock:
+            self._conn.execute("DELETE FROM completions")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache() -> CompletionCache:
+    """Returns the process-wide cache, creating it on first use."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            path = os.getenv("AZURE_OPENAI_CACHE_PATH", os.path.join(parent_dir, ".llm_cache", "completions.sqlite"))
+            _default_cache = CompletionCache(path)
+        return _default_cache
+
+
+def set_default_cache(cache: CompletionCache):
+    """Replaces the process-wide cache, e.g. to change its location or limits."""
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = cache
@@ -34,12 +34,12 @@ import phonenumbers
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse
 
-import requests
 import asyncio
 from requests_html import AsyncHTMLSession
 
 from alive_progress import alive_bar
 from utils import *
+from http_client import fetch, close_sessions
 
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -112,7 +112,7 @@ def google_contact_scraper(url):
         'hl': 'en'
     }
     
-    response = requests.get('https://www.google.com/search', params=params, headers=google_headers)
+    response = fetch('https://www.google.com/search', params=params, headers=google_headers)
     soup = str(BeautifulSoup(response.content, 'lxml'))
     
     address = re.findall('<span class="LrzXr">(.*?)<\/span>', soup) 
@@ -289,6 +289,8 @@ async def main(config_file):
 
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
+    finally:
+        close_sessions()
     
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+"""
+Local stand-in for the Azure OpenAI chat completions and embeddings endpoints.
+
+Used to load-test azure_openai_cookbook without spending real quota. The server can simulate
+response latency, 429s with retry-after headers (randomly, and whenever its own per-minute
+token/request quota is exceeded), 400 content-filter errors and JSON-mode output, including the
+{"<id>": "<answer>"} objects expected by add_filter_column_batch. Streamed completions (stream=True)
+are sent as server-sent events, one chunk per word, with the usage chunk sent when requested
+through stream_options.
+
+To run this script on its own, run 'python fake_azure_openai_server.py <config path>' and point an
+AzureAPIConfig at the printed endpoint. If no path is provided, default settings will be used.
+It can also be started in-process with start_fake_server().
+"""
+
+import sys
+import re
+import json
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeServerConfig:
+    """Behaviour of the fake server.
+
+    Attributes:
+        host (str): Interface to listen on.
+        port (int): Port to listen on (0 picks a free port).
+        latency (float): Mean response time in seconds.
+        latency_jitter (float): Response times are drawn uniformly from latency +/- latency_jitter.
+        seconds_per_output_token (float): Extra generation time per completion token.
+        completion_tokens (int): Length of a generated answer, in (approximate) tokens.
+        rate_limit_rate (float): Probability of answering a request with a random 429.
+        retry_after_ms (int): Value of the retry-after-ms header sent with 429s.
+        content_filter_rate (float): Probability of answering a request with a 400 content-filter error.
+        tokens_per_minute_limit (int): Simulated token quota. 0 disables it.
+        requests_per_minute_limit (int): Simulated request quota. 0 disables it.
+        embedding_dim (int): Size of the returned embedding vectors.
+    """
+    def __init__(self, config: dict = None):
+        config = config or {}
+        self.host = config.get('host', '127.0.0.1')
+        self.port = config.get('port', 0)
+        self.latency = config.get('latency', 0.5)
+        self.latency_jitter = config.get('latency_jitter', 0.2)
+        self.seconds_per_output_token = config.get('seconds_per_output_token', 0.0)
+        self.completion_tokens = config.get('completion_tokens', 20)
+        self.rate_limit_rate = config.get('rate_limit_rate', 0.0)
+        self.retry_after_ms = config.get('retry_after_ms', 1000)
+        self.content_filter_rate = config.get('content_filter_rate', 0.0)
+        self.tokens_per_minute_limit = config.get('tokens_per_minute_limit', 0)
+        self.requests_per_minute_limit = config.get('requests_per_minute_limit', 0)
+        self.embedding_dim = config.get('embedding_dim', 1536)
+
+    @classmethod
+    def from_file(cls, config_path):
+        with open(config_path, 'r') as file:
+            return cls(json.load(file))
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token), so the server does not need tiktoken."""
+    return max(1, len(text) // 4)
+
+
+class _Quota:
+    """Sliding one-minute window of requests and tokens, like the Azure quota."""
+    def __init__(self, tokens_per_minute_limit, requests_per_minute_limit):
+        self.tokens_per_minute_limit = tokens_per_minute_limit
+        self.requests_per_minute_limit = requests_per_minute_limit
+        self.window = []  # (timestamp, tokens)
+        self.lock = threading.Lock()
+
+    def try_consume(self, tokens):
+        """Returns 0 if the request fits in the quota, otherwise the seconds until it would."""
+        with self.lock:
+            now = time.monotonic()
+            self.window = [(t, n) for t, n in self.window if t > now - 60]
+            used_tokens = sum(n for _, n in self.window)
+            over_tokens = self.tokens_per_minute_limit and used_tokens + tokens > self.tokens_per_minute_limit
+            over_requests = self.requests_per_minute_limit and len(self.window) + 1 > self.requests_per_minute_limit
+            if over_tokens or over_requests:
+                return max(0.1, self.window[0][0] + 60 - now) if self.window else 1.0
+            self.window.append((now, tokens))
+            return 0
+
+    def remaining(self):
+        with self.lock:
+            return (self.requests_per_minute_limit - len(self.window) if self.requests_per_minute_limit else None,
+                    self.tokens_per_minute_limit - sum(n for _, n in self.window) if self.tokens_per_minute_limit else None)
+
+
+class FakeAzureOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real endpoint
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output readable
+
+    def do_POST(self):
+        config, quota = self.server.config, self.server.quota
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        match = re.match(r'^/openai/deployments/([^/]+)/(chat/completions|embeddings)', self.path)
+        if not match:
+            return self._send_json(404, {"error": {"code": "404", "message": "Resource not found"}})
+        deployment, endpoint = match.groups()
+        self.server.count('requests')
+
+        if endpoint == 'embeddings':
+            inputs = body.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            prompt_tokens = sum(estimate_tokens(text) for text in inputs)
+            max_tokens = 0
+        else:
+            prompt = "\n".join(str(message.get('content', '')) for message in body.get('messages', []))
+            prompt_tokens = estimate_tokens(prompt)
+            max_tokens = body.get('max_tokens') or 4096
+
+        # Azure counts prompt tokens + max_tokens against the quota when the request arrives
+        wait = quota.try_consume(prompt_tokens + max_tokens)
+        if not wait and random.random() < config.rate_limit_rate:
+            wait = config.retry_after_ms / 1000
+        if wait:
+            self.server.count('rate_limited')
+            return self._send_json(429, {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit."}},
+                                   {"retry-after": str(int(wait) + 1), "retry-after-ms": str(int(wait * 1000))})
+        if random.random() < config.content_filter_rate:
+            self.server.count('content_filtered')
+            return self._send_json(400, {"error": {"code": "content_filter", "status": 400,
+                                                   "message": "The response was filtered due to the prompt triggering Azure OpenAI's content management policy."}})
+
+        time.sleep(max(0, config.latency + random.uniform(-config.latency_jitter, config.latency_jitter)))
+        if endpoint == 'embeddings':
+            return self._send_json(200, self._embedding_response(deployment, inputs, prompt_tokens))
+
+        content = self._completion_content(prompt, body.get('response_format'))
+        completion_tokens = min(estimate_tokens(content), max_tokens)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        if body.get('stream'):
+            include_usage = (body.get('stream_options') or {}).get('include_usage', False)
+            self._send_stream(deployment, content, usage if include_usage else None, completion_tokens)
+            self.server.count('completed')
+            return
+        time.sleep(completion_tokens * config.seconds_per_output_token)
+        self.server.count('completed')
+        return self._send_json(200, {
+            "id": f"chatcmpl-fake-{random.getrandbits(32):08x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": usage
+        })
+
+    def _completion_content(self, prompt, response_format):
+        answer = " ".join(["lorem"] * self.server.config.completion_tokens)
+        if not response_format or response_format.get('type') != 'json_object':
+            return answer
+        item_ids = re.findall(r'^\[(\d+)\] ', prompt, flags=re.MULTILINE)
+        if item_ids:  # Batch prompt from build_batch_prompt
+            return json.dumps({item_id: answer for item_id in item_ids})
+        return json.dumps({"summary": answer, "positive_aspects": ["lorem"], "negative_aspects": [], "neutral_aspects": []})
+
+    def _embedding_response(self, deployment, inputs, prompt_tokens):
+        dim = self.server.config.embedding_dim
+        data = []
+        for i, text in enumerate(inputs):
+            rng = random.Random(text)  # Same text, same vector
+            data.append({"object": "embedding", "index": i, "embedding": [rng.uniform(-1, 1) for _ in range(dim)]})
+        self.server.count('completed')
+        return {"object": "list", "model": deployment, "data": data,
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}}
+
+    def _send_stream(self, deployment, content, usage, completion_tokens):
+        """Sends the completion as server-sent events, spreading the generation time over the words."""
+        chunk_info = {"id": f"chatcmpl-fake-{random.getrandbits(32):08x}", "object": "chat.completion.chunk",
+                      "created": int(time.time()), "model": deployment}
+        words = re.findall(r'\S+\s*', content) or [content]
+        seconds_per_word = completion_tokens * self.server.config.seconds_per_output_token / len(words)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send_event(data):
+            event = f"data: {data}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(event):x}\r\n".encode('ascii') + event + b"\r\n")
+            self.wfile.flush()
+
+        try:
+            send_event(json.dumps({**chunk_info, "choices": [], "prompt_filter_results": []}))  # Azure sends prompt filter results first
+            for i, word in enumerate(words):
+                time.sleep(seconds_per_word)
+                delta = {"role": "assistant", "content": word} if i == 0 else {"content": word}
+                send_event(json.dumps({**chunk_info, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}))
+            send_event(json.dumps({**chunk_info, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+            if usage is not None:
+                send_event(json.dumps({**chunk_info, "choices": [], "usage": usage}))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):  # Client stopped reading the stream
+            self.close_connection = True
+
+    def _send_json(self, status, payload, extra_headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        remaining_requests, remaining_tokens = self.server.quota.remaining()
+        if remaining_requests is not None:
+            self.send_header('x-ratelimit-remaining-requests', str(remaining_requests))
+        if remaining_tokens is not None:
+            self.send_header('x-ratelimit-remaining-tokens', str(remaining_tokens))
+        for key, value in (extra_headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeAzureOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: FakeServerConfig):
+        super().__init__((config.host, config.port), FakeAzureOpenAIHandler)
+        self.config = config
+        self.quota = _Quota(config.tokens_per_minute_limit, config.requests_per_minute_limit)
+        self.stats = {"requests": 0, "completed": 0, "rate_limited": 0, "content_filtered": 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+
+def start_fake_server(config: FakeServerConfig = None) -> FakeAzureOpenAIServer:
+    """Starts the server on a background thread and returns it. Call server.shutdown() to stop it."""
+    server = FakeAzureOpenAIServer(config or FakeServerConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(config_file):
+    config = FakeServerConfig.from_file(config_file) if config_file else FakeServerConfig({"port": 8089})
+    server = FakeAzureOpenAIServer(config)
+    print(f"Fake Azure OpenAI server listening on {server.endpoint} (Ctrl+C to stop).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"[✓] Server stopped. {server.stats}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        config_file_path = sys.argv[1]
+    else:
+        print("No configuration file provided. Using default configuration.")
+        config_file_path = None
+
+    main(config_file_path)
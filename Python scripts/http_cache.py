@@ -0,0 +1,288 @@
+"""
+On-disk HTTP cache for the scrapers.
+
+GET responses fetched through http_client.fetch are stored in a SQLite database keyed by URL,
+with their bodies zlib-compressed. A cached page is served locally while it is fresh, i.e.
+younger than the TTL of its source (see DEFAULT_TTL_POLICY). Once it goes stale, it is
+revalidated with a conditional GET (If-None-Match / If-Modified-Since) when the server sent an
+ETag or Last-Modified header, so an unchanged page costs a 304 instead of a full download. Once
+the database grows past its size limit, entries are evicted least-recently-used first.
+
+Modes:
+    'normal': Serve fresh entries, revalidate stale ones.
+    'refresh': Revalidate every entry, however fresh.
+    'offline': Replay only. Serve any cached entry and never touch the network. Misses return a
+               504 response.
+    'off': Bypass the cache.
+
+The default cache lives at '.http_cache/pages.sqlite' in the repo root. It can be moved by
+setting the SCRAPER_HTTP_CACHE_PATH environment variable, and its mode can be set with
+SCRAPER_HTTP_CACHE_MODE (e.g. 'offline' to re-run a scraper against the pages of the last run).
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+import requests
+from urllib.parse import urlparse
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CACHE_MODES = ('normal', 'refresh', 'offline', 'off')
+CACHEABLE_STATUS_CODES = (200, 203, 404, 410)  # 404s are cached too, the scrapers use them to detect the last page
+
+# Seconds a page stays fresh, by host (subdomains included). Other hosts use the default TTL.
+DEFAULT_TTL_POLICY = {
+    'trustpilot.com': 12 * 3600,  # Review pages sorted by recency change as new reviews come in
+    'api.pullpush.io': 0,  # Never fresh: fetch_newest reruns request the same URL and must see new items
+    'google.com': 7 * 24 * 3600,  # Business listings rarely change
+    'musicbiz.org': 7 * 24 * 3600
+}
+
+# Decoded bodies are stored, so these no longer describe them
+_SKIPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+
+
+class HttpCache:
+    """Persistent URL/response cache backed by SQLite.
+
+    Attributes:
+        path (str): Location of the SQLite database file.
+        mode (str): One of CACHE_MODES.
+        ttl_policy (dict): Host -> seconds a page from that host stays fresh.
+        default_ttl (float): Freshness of pages from hosts missing from ttl_policy.
+        max_size_bytes (int): Total size of stored (compressed) bodies before LRU eviction kicks in.
+        hits (int): Number of fetches served from the cache without contacting the server.
+        revalidated (int): Number of stale entries confirmed unchanged by a 304.
+        misses (int): Number of fetches that downloaded a full response.
+    """
+    def __init__(self, path: str, mode: str = 'normal', ttl_policy: dict = None, default_ttl: float = 24 * 3600,
+                 max_size_bytes: int = 1024 * 1024 * 1024, evict_every: int = 100):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Invalid cache mode: {mode}. Use one of {CACHE_MODES}.")
+        self.path = path
+        self.mode = mode
+        self.ttl_policy = DEFAULT_TTL_POLICY if ttl_policy is None else ttl_policy
+        self.default_ttl = default_ttl
+        self.max_size_bytes = max_size_bytes
+        self.evict_every = evict_every
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._puts_since_eviction = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_last_access ON pages(last_access)")
+        self._conn.commit()
+
+    def get_ttl(self, url: str) -> float:
+        """Returns how long a page from the URL's host stays fresh."""
+        host = (urlparse(url).hostname or '').lower()
+        for source, ttl in self.ttl_policy.items():
+            if host == source or host.endswith('.' + source):
+                return ttl
+        return self.default_ttl
+
+    def fetch(self, session: requests.Session, url: str, **kwargs) -> requests.Response:
+        """ Sends a GET request through the cache.
+
+        Args:
+            session: Session used when the server has to be contacted.
+            url: Full URL, including the query string. It is the cache key.
+            kwargs: Passed on to session.get (headers, timeout, ...).
+        """
+        if self.mode == 'off':
+            return session.get(url, **kwargs)
+        response, entry = self.lookup(url)
+        if response is not None:
+            return response
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.update(self.conditional_headers(entry))
+        return self.update(url, entry, session.get(url, headers=headers, **kwargs))
+
+    def lookup(self, url: str):
+        """
+        Returns (response, entry). response is set if the URL can be answered without contacting 
+        the server (a fresh entry, or any lookup in offline mode). Otherwise the request should 
+        be sent with conditional_headers(entry) and its response passed to update().
+        """
+        now = time.time()
+        entry = self._lookup(url)
+        if self.mode == 'offline':
+            return (self._hit(url, entry, now) if entry is not None else self._offline_miss(url)), entry
+        if entry is not None and self.mode == 'normal' and now - entry['fetched_at'] < self.get_ttl(url):
+            return self._hit(url, entry, now), entry
+        return None, entry
+
+    @staticmethod
+    def conditional_headers(entry) -> dict:
+        """Returns the If-None-Match/If-Modified-Since headers that revalidate a stale entry."""
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(self, url: str, entry, response: requests.Response) -> requests.Response:
+        """Stores a fresh response, or serves the cached entry if the server answered 304."""
+        now = time.time()
+        if response.status_code == 304 and entry is not None:
+            with self._lock:
+                self._conn.execute("UPDATE pages SET fetched_at = ?, last_access = ? WHERE url = ?", (now, now, url))
+                self._conn.commit()
+                self.revalidated += 1
+            return self._build_response(url, entry, 'REVALIDATED')
+
+        with self._lock:
+            self.misses += 1
+        if response.status_code in CACHEABLE_STATUS_CODES:
+            self._store(url, response, now)
+        response.from_cache = False
+        return response
+
+    def _lookup(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, headers, body, etag, last_modified, fetched_at FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('status', 'headers', 'body', 'etag', 'last_modified', 'fetched_at'), row))
+
+    def _hit(self, url, entry, now):
+        with self._lock:
+            self._conn.execute("UPDATE pages SET last_access = ? WHERE url = ?", (now, url))
+            self._conn.commit()
+            self.hits += 1
+        return self._build_response(url, entry, 'HIT')
+
+    def _offline_miss(self, url):
+        with self._lock:
+            self.misses += 1
+        response = requests.Response()
+        response.status_code = 504
+        response.reason = 'Gateway Timeout (not in offline cache)'
+        response.url = url
+        response._content = b''
+        response.from_cache = False
+        return response
+
+    @staticmethod
+    def _build_response(url, entry, cache_status):
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(json.loads(entry['headers']))
+        response.headers['X-Cache'] = cache_status
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = url
+        response._content = zlib.decompress(entry['body'])
+        response.from_cache = True
+        return response
+
+    def _store(self, url, response, now):
+        body = zlib.compress(response.content, 6)
+        headers = {key: value for key, value in response.headers.items() if key.lower() not in _SKIPPED_HEADERS}
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (url, status, headers, body, size, etag, last_modified, fetched_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, response.status_code, json.dumps(headers), body, len(body),
+                 response.headers.get('ETag'), response.headers.get('Last-Modified'), now, now))
+            self._conn.commit()
+            self._puts_since_eviction += 1
+            if self._puts_since_eviction >= self.evict_every:
+                self._evict()
+
+    def delete(self, url: str):
+        """Removes the entry of a URL, e.g. a 200 page that turned out to be an error page."""
+        with self._lock:
+            self._conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._conn.commit()
+
+    def evict(self):
+        """Removes least-recently-used entries until under max_size_bytes."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        self._puts_since_eviction = 0
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total_size > self.max_size_bytes:
+            excess = total_size - self.max_size_bytes
+            rows = self._conn.execute("SELECT url, size FROM pages ORDER BY last_access ASC")
+            stale_urls = []
+            for url, size in rows:
+                if excess <= 0:
+                    break
+                stale_urls.append((url,))
+                excess -= size
+            self._conn.executemany("DELETE FROM pages WHERE url = ?", stale_urls)
+        self._conn.commit()
+
+    def stats(self) -> dict:
+        """Returns hit/revalidation/miss counters along with the number and total size of stored entries."""
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size
+        }
+
+    def clear(self):
+        """Deletes every stored entry and resets the counters."""
+        with self._lock:
+            self._conn.execute("DELETE FROM pages")
+            self._conn.commit()
+            self.hits = 0
+            self.revalidated = 0
+            self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_http_cache() -> HttpCache:
+    """Returns the process-wide HTTP cache, creating it on first use."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            path = os.getenv("SCRAPER_HTTP_CACHE_PATH", os.path.join(parent_dir, ".http_cache", "pages.sqlite"))
+            _default_cache = HttpCache(path, mode=os.getenv("SCRAPER_HTTP_CACHE_MODE", "normal"))
+        return _default_cache
+
+
+def set_default_http_cache(cache: HttpCache):
+    """Replaces the process-wide HTTP cache, e.g. to change its location, mode or TTL policy."""
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = cache
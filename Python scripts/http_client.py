@@ -0,0 +1,140 @@
+"""
+Shared HTTP fetch layer for the scrapers.
+
+Every page is fetched through a long-lived requests.Session (one per thread, since sessions are
+not guaranteed to be thread-safe). Each session keeps a pool of keep-alive connections per host,
+so the dozens of pages fetched from trustpilot.com or api.pullpush.io in a run reuse the same
+TCP/TLS connections instead of opening a new one for every page. Responses are decoded from
+gzip/deflate, and from brotli when the 'brotli' (or 'brotlicffi') package is installed.
+
+Connection errors, timeouts and 429/5xx responses are retried with exponential backoff according
+to the current FetchPolicy, honouring Retry-After headers. Responses are returned whatever their
+final status code, like requests.get. Fetches go through the on-disk HTTP cache in http_cache
+unless use_cache=False is passed.
+
+Usage:
+    response = fetch('https://www.trustpilot.com/review/playlistpush.com', headers=headers)
+    set_fetch_policy(FetchPolicy(timeout=(5, 60), retries=5))
+"""
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from http_cache import get_default_http_cache
+
+try:
+    import brotli  # Lets urllib3 decode 'br' responses
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    try:
+        import brotlicffi
+        ACCEPT_ENCODING = 'gzip, deflate, br'
+    except ImportError:
+        ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class FetchPolicy:
+    """Connection pooling, timeout and retry settings shared by all fetches.
+
+    Attributes:
+        timeout (tuple): (connect, read) timeouts in seconds.
+        retries (int): Max number of retries after a connection error, timeout or retryable status.
+        backoff_factor (float): Retries wait backoff_factor * 2 ** (retry number - 1) seconds.
+        status_forcelist (tuple): Status codes that are retried.
+        respect_retry_after (bool): If True, wait as long as the Retry-After header asks on 429/503.
+        pool_connections (int): Number of hosts whose connection pools are kept.
+        pool_maxsize (int): Max number of keep-alive connections kept per host.
+    """
+    def __init__(self, timeout: tuple = (10, 30), retries: int = 3, backoff_factor: float = 1.0,
+                 status_forcelist: tuple = (429, 500, 502, 503, 504), respect_retry_after: bool = True,
+                 pool_connections: int = 20, pool_maxsize: int = 10):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+        self.respect_retry_after = respect_retry_after
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+
+    def build_retry(self) -> Retry:
+        return Retry(total=self.retries, connect=self.retries, read=self.retries, status=self.retries,
+                     backoff_factor=self.backoff_factor, status_forcelist=self.status_forcelist,
+                     allowed_methods=frozenset(['GET', 'HEAD']), respect_retry_after_header=self.respect_retry_after,
+                     raise_on_status=False)  # Return the last response instead of raising, like requests.get
+
+
+_policy = FetchPolicy()
+_policy_version = 0
+_local = threading.local()
+_sessions = []
+_sessions_lock = threading.Lock()
+
+
+def set_fetch_policy(policy: FetchPolicy):
+    """Replaces the fetch policy. Sessions are rebuilt with it on their next fetch."""
+    global _policy, _policy_version
+    with _sessions_lock:
+        _policy = policy
+        _policy_version += 1
+
+
+def get_fetch_policy() -> FetchPolicy:
+    return _policy
+
+
+def _build_session(policy: FetchPolicy) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=policy.pool_connections, pool_maxsize=policy.pool_maxsize,
+                          max_retries=policy.build_retry())
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+
+def get_session() -> requests.Session:
+    """Returns the calling thread's pooled session, creating it on first use."""
+    session = getattr(_local, 'session', None)
+    if session is None or _local.policy_version != _policy_version:
+        with _sessions_lock:
+            if session is not None:
+                session.close()
+                if session in _sessions:
+                    _sessions.remove(session)
+            session = _build_session(_policy)
+            _sessions.append(session)
+            _local.policy_version = _policy_version
+        _local.session = session
+    return session
+
+
+def fetch(url: str, params: dict = None, headers: dict = None, timeout=None, use_cache: bool = True, 
+          **kwargs) -> requests.Response:
+    """ Sends a GET request through the calling thread's pooled session.
+
+    Args:
+        url: URL to fetch.
+        params: Optional query string parameters.
+        headers: Optional request headers (e.g. utils.headers). Accept-Encoding is added if missing.
+        timeout: (connect, read) timeout in seconds. Defaults to the fetch policy's timeout.
+        use_cache: If False, bypass the on-disk HTTP cache.
+        kwargs: Passed on to requests.Session.get.
+    """
+    timeout = timeout if timeout is not None else _policy.timeout
+    if not use_cache:
+        return get_session().get(url, params=params, headers=headers, timeout=timeout, **kwargs)
+    if params:
+        url = requests.Request('GET', url, params=params).prepare().url  # The cache is keyed by the full URL
+    return get_default_http_cache().fetch(get_session(), url, headers=headers, timeout=timeout, **kwargs)
+
+
+def close_sessions():
+    """Closes every session (and their pooled connections), e.g. at the end of a script."""
+    global _policy_version
+    with _sessions_lock:
+        for session in _sessions:
+            session.close()
+        _sessions.clear()
+        _policy_version += 1  # Threads build a new session on their next fetch
+    _local.session = None
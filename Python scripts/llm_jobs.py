@@ -0,0 +1,199 @@
+"""
+Checkpointed, resumable versions of the cookbook's LLM column functions.
+
+Every completed row is appended to a JSONL journal (one JSON object per line, keyed by the row's
+index) as soon as its response arrives. Re-running a job with the same journal skips rows that
+already succeeded, so a crash or a killed kernel only loses the requests that were in flight.
+Records are flushed to the OS on every write and fsynced in batches, so only a power loss can drop
+the last few rows.
+Rows that failed are retried at the end of the run.
+
+The journal starts with a header record holding a fingerprint of the job (prompt, source and target
+columns, deployment and generation parameters). A journal written by a different job is never
+resumed, since its answers would be stale for the new prompt or column.
+
+Usage:
+    result_df = run_filter_column_job(df, 'ReviewContent', 'is_scam', prompt, model_config,
+                                      api_config, journal_path='jobs/is_scam.jsonl')
+"""
+
+import os
+import json
+import hashlib
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from azure_openai_cookbook import (AzureOpenAIConfig, AzureAPIConfig, get_completion_string, get_rate_limiter,
+                                   get_response_cost, estimate_num_tokens_from_str, validate_total_tokens)
+
+
+class JobJournal:
+    """Append-only JSONL journal of row results.
+
+    Each record has the row id (the DataFrame index, as a string), a status ('done' or 'failed'),
+    the value written to the target column, the cost of the call and, for failures, the error.
+    When a row appears more than once, the last record wins.
+
+    The first line is a header with the job's fingerprint (see make_fingerprint). Opening an existing
+    journal with a different fingerprint, or one without a header, raises a ValueError.
+
+    Records are flushed on every write and fsynced every fsync_every records and on close.
+    Use it as a context manager so the journal is closed even if the job raises.
+    """
+    def __init__(self, path: str, fingerprint: str, fsync_every: int = 100):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.fsync_every = fsync_every
+        self._unsynced = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._check_header()
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() == 0:
+            self._write({"header": True, "fingerprint": fingerprint})
+
+    @staticmethod
+    def make_fingerprint(**job) -> str:
+        """Hashes the settings that determine the answers of a job."""
+        return hashlib.sha256(json.dumps(job, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _check_header(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, 'r', encoding='utf-8') as file:
+            try:
+                header = json.loads(file.readline())
+            except json.JSONDecodeError:
+                header = {}
+        if not header.get("header"):
+            raise ValueError(f"Journal {self.path} has no job header, so it cannot be checked against this job. "
+                             "Use a new journal_path.")
+        if header.get("fingerprint") != self.fingerprint:
+            raise ValueError(f"Journal {self.path} was written by a different job (prompt, columns, deployment or "
+                             "generation parameters changed). Use a new journal_path to start over.")
+
+    def _write(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def load(self) -> dict:
+        """Returns the latest record for every row in the journal, keyed by row id."""
+        records = {}
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Partially written last line from a crash
+                if record.get("header"):
+                    continue
+                records[record['row_id']] = record
+        return records
+
+    def append(self, row_id, status: str, value=None, cost: float = 0.0, error: str = None):
+        """Appends a record and flushes it before returning."""
+        self._write({"row_id": str(row_id), "status": status, "value": value, "cost": cost, "error": error})
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def run_filter_column_job(df: pd.DataFrame, source_col: str, target_col: str, prompt: str,
+                          model_config: AzureOpenAIConfig, api_config: AzureAPIConfig, journal_path: str,
+                          max_workers: int = 8, max_retry_rounds: int = 2, use_cache: bool = True):
+    """ Resumable version of add_filter_column_concurrent.
+
+    Params:
+    df: Dataframe to add column to
+    source_col: Name of column containing source data
+    target_col: Name of new column to be created
+    prompt: Prompt to pass into completions API
+    model_config: Azure openAI model configuration
+    api_configuration: Azure openAI API configuration
+    journal_path: JSONL file that completed rows are appended to. Reuse it to resume the job. A journal
+                  written with a different prompt, column or model raises a ValueError.
+    max_workers: Max number of requests in flight at the same time
+    max_retry_rounds: Number of extra passes over failed rows at the end of the run
+    use_cache: If False, bypass the on-disk completion cache
+    """
+    fingerprint = JobJournal.make_fingerprint(
+        prompt=prompt, source_col=source_col, target_col=target_col, deployment=model_config.deployment,
+        params={"max_tokens": model_config.max_output, "response_format": "text"})  # Same params as get_completion_string
+    with JobJournal(journal_path, fingerprint) as journal:
+        records = journal.load()
+        done = {row_id for row_id, record in records.items() if record['status'] == 'done'}
+        pending_df = df[~df.index.astype(str).isin(done)]
+        print(f"Resuming job: {len(df) - len(pending_df)}/{len(df)} items already done, "
+              f"${sum(record['cost'] for record in records.values()):.2f} spent previously.")
+
+        total_api_cost = 0.0
+        if not pending_df.empty:
+            token_counts = validate_total_tokens(pending_df, source_col, prompt, model_config)  # Only validate rows that still need work
+            prompt_tokens = estimate_num_tokens_from_str(prompt, model_config)
+            rate_limiter = get_rate_limiter(model_config)
+            pending = list(pending_df.index)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for round_num in range(max_retry_rounds + 1):
+                    if not pending:
+                        break
+                    if round_num > 0:
+                        print(f"Retrying {len(pending)} failed items (round {round_num}/{max_retry_rounds}).")
+
+                    futures = {}
+                    for index in pending:
+                        current_prompt = prompt + df.at[index, source_col]
+                        num_prompt_tokens = prompt_tokens + int(token_counts[index])
+                        future = executor.submit(get_completion_string, current_prompt, model_config, api_config,
+                                                 use_cache=use_cache, rate_limiter=rate_limiter, num_prompt_tokens=num_prompt_tokens)
+                        futures[future] = (index, current_prompt, num_prompt_tokens)
+
+                    failed = []
+                    for future in as_completed(futures):
+                        index, current_prompt, num_prompt_tokens = futures[future]
+                        try:
+                            response = future.result()
+                        except Exception as e:
+                            print(f"Error processing item at index {index}: {e}")
+                            journal.append(index, 'failed', error=str(e))
+                            failed.append(index)
+                            continue
+
+                        value = response.choices[0].message.content if response else response
+                        cost = get_response_cost(response, current_prompt, model_config, num_prompt_tokens)
+                        journal.append(index, 'done', value=value, cost=cost)
+                        total_api_cost += cost
+                        done.add(str(index))
+
+                        print(f"Total processed so far: {len(done)}/{len(df)}, Cost so far: ${total_api_cost:.2f}")
+                    pending = failed
+
+        records = journal.load()
+
+    result_df = df.copy(deep=True)
+    result_df.loc[:, target_col] = ''  # Creating empty column to store result
+    for index in result_df.index:
+        record = records.get(str(index))
+        if record is not None and record['status'] == 'done':
+            result_df.loc[index, target_col] = record['value']
+
+    failed_count = (~df.index.astype(str).isin(done)).sum()
+    if failed_count:
+        print(f"{failed_count} items still failed. Re-run the job with the same journal to retry them.")
+    return result_df
@@ -0,0 +1,233 @@
+"""
+In-process metrics for Azure OpenAI calls.
+
+Every request made through azure_openai_cookbook is recorded here with its deployment, token
+usage, cost, latency, time to first byte (and first token, for streamed completions), retry
+count and outcome ('ok', 'content_filter', 'error', 'cancelled' or 'cache_hit'). The registry
+aggregates the records into counters and histograms that can be written as a Prometheus
+text-format file, and can stream the raw records of a job to a JSONL trace. The achieved tokens per
+minute over the last minute is exported next to the deployment's tokens_per_minute_limit, which
+shows whether a job is bound by quota, latency or retries.
+
+Usage:
+    with trace_job('traces/is_scam.jsonl', job='is_scam'):
+        result_df = add_filter_column_concurrent(df, ...)
+    get_registry().write_prometheus('metrics/llm.prom')
+"""
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+
+
+class CallRecord:
+    """Metrics of a single API call (including all of its retries).
+
+    Attributes:
+        deployment (str): Azure deployment name.
+        outcome (str): 'ok', 'content_filter' (400), 'error', 'cancelled' (stream stopped early) or 'cache_hit'.
+        prompt_tokens (int): Prompt tokens billed.
+        completion_tokens (int): Completion tokens billed.
+        cost (float): Cost of the call in dollars.
+        latency (float): Seconds taken by the final attempt.
+        time_to_first_byte (float): Seconds until the response headers of the final attempt arrived.
+        time_to_first_token (float): Seconds until the first content delta of a streamed completion arrived.
+        wait_time (float): Seconds between the first and the final attempt (429 pauses, backoff and failed attempts).
+        retries (int): Number of attempts that were retried.
+        tokens_per_minute_limit (int): Quota of the deployment.
+    """
+    def __init__(self, deployment: str, outcome: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 cost: float = 0.0, latency: float = None, time_to_first_byte: float = None, wait_time: float = 0.0,
+                 retries: int = 0, tokens_per_minute_limit: int = None, time_to_first_token: float = None):
+        self.timestamp = time.time()
+        self.deployment = deployment
+        self.outcome = outcome
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cost = cost
+        self.latency = latency
+        self.time_to_first_byte = time_to_first_byte
+        self.time_to_first_token = time_to_first_token
+        self.wait_time = wait_time
+        self.retries = retries
+        self.tokens_per_minute_limit = tokens_per_minute_limit
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Thread-safe aggregation of CallRecords."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trace_file = None
+        self.reset()
+
+    def reset(self):
+        """Clears every metric and closes the open JSONL trace, if any."""
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()  # Flushes the buffered trace lines
+            self.requests = defaultdict(int)  # (deployment, outcome) -> count
+            self.prompt_tokens = defaultdict(int)
+            self.completion_tokens = defaultdict(int)
+            self.cost = defaultdict(float)
+            self.retries = defaultdict(int)
+            self.latency = defaultdict(lambda: _Histogram(LATENCY_BUCKETS))
+            self.time_to_first_byte = defaultdict(lambda: _Histogram(LATENCY_BUCKETS))
+            self.time_to_first_token = defaultdict(lambda: _Histogram(LATENCY_BUCKETS))
+            self.wait_time = defaultdict(lambda: _Histogram(LATENCY_BUCKETS))
+            self.quota_wait = defaultdict(lambda: _Histogram(LATENCY_BUCKETS))
+            self.tpm_limits = {}
+            self._recent_tokens = defaultdict(deque)  # deployment -> (timestamp, tokens) of the last minute
+            self._trace_file = None
+            self._trace_job = None
+
+    def record(self, call: CallRecord):
+        with self._lock:
+            deployment = call.deployment
+            self.requests[(deployment, call.outcome)] += 1
+            self.prompt_tokens[deployment] += call.prompt_tokens
+            self.completion_tokens[deployment] += call.completion_tokens
+            self.cost[deployment] += call.cost
+            self.retries[deployment] += call.retries
+            if call.latency is not None:
+                self.latency[deployment].observe(call.latency)
+            if call.time_to_first_byte is not None:
+                self.time_to_first_byte[deployment].observe(call.time_to_first_byte)
+            if call.time_to_first_token is not None:
+                self.time_to_first_token[deployment].observe(call.time_to_first_token)
+            self.wait_time[deployment].observe(call.wait_time)
+            if call.tokens_per_minute_limit is not None:
+                self.tpm_limits[deployment] = call.tokens_per_minute_limit
+            if call.outcome != 'cache_hit':
+                self._recent_tokens[deployment].append((call.timestamp, call.prompt_tokens + call.completion_tokens))
+
+            if self._trace_file is not None:
+                record = call.to_dict()
+                record['job'] = self._trace_job
+                self._trace_file.write(json.dumps(record) + '\n')
+                self._trace_file.flush()
+
+    def observe_quota_wait(self, deployment: str, seconds: float):
+        """Records time a call spent blocked in the RateLimiter before being sent."""
+        with self._lock:
+            self.quota_wait[deployment].observe(seconds)
+
+    def achieved_tpm(self, deployment: str):
+        """Returns the number of tokens processed by the deployment over the last 60 seconds."""
+        with self._lock:
+            return self._achieved_tpm(deployment)
+
+    def _achieved_tpm(self, deployment):
+        recent = self._recent_tokens[deployment]
+        cutoff = time.time() - 60
+        while recent and recent[0][0] < cutoff:
+            recent.popleft()
+        return sum(tokens for _, tokens in recent)
+
+    def start_trace(self, path: str, job: str = None):
+        """Starts appending every recorded call to a JSONL file."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+            self._trace_file = open(path, 'a', encoding='utf-8')
+            self._trace_job = job
+
+    def stop_trace(self):
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+            self._trace_file = None
+            self._trace_job = None
+
+    def to_prometheus(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_str = ",".join(f'{key}="{value_}"' for key, value_ in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}")
+
+        def add_histogram(name, help_text, histograms):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for deployment, histogram in histograms.items():
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{name}_bucket{{deployment="{deployment}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{deployment="{deployment}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{deployment="{deployment}"}} {histogram.total}')
+                lines.append(f'{name}_count{{deployment="{deployment}"}} {histogram.count}')
+
+        with self._lock:
+            deployments = sorted(set(self.prompt_tokens) | set(self.tpm_limits))
+            add_metric("llm_requests_total", "counter", "Number of API calls by outcome.",
+                       [({"deployment": d, "outcome": o}, n) for (d, o), n in sorted(self.requests.items())])
+            add_metric("llm_prompt_tokens_total", "counter", "Prompt tokens billed.",
+                       [({"deployment": d}, self.prompt_tokens[d]) for d in deployments])
+            add_metric("llm_completion_tokens_total", "counter", "Completion tokens billed.",
+                       [({"deployment": d}, self.completion_tokens[d]) for d in deployments])
+            add_metric("llm_cost_dollars_total", "counter", "Cost of all calls in dollars.",
+                       [({"deployment": d}, self.cost[d]) for d in deployments])
+            add_metric("llm_retries_total", "counter", "Attempts that were retried (429s and transient errors).",
+                       [({"deployment": d}, self.retries[d]) for d in deployments])
+            add_histogram("llm_request_latency_seconds", "Duration of the final attempt of each call.", self.latency)
+            add_histogram("llm_time_to_first_byte_seconds", "Time until the response headers arrived.", self.time_to_first_byte)
+            add_histogram("llm_time_to_first_token_seconds", "Time until the first content delta of streamed completions arrived.", 
+                          self.time_to_first_token)
+            add_histogram("llm_retry_wait_seconds", "Time between the first and the final attempt of each call.", self.wait_time)
+            add_histogram("llm_quota_wait_seconds", "Time spent blocked in the rate limiter before sending.", self.quota_wait)
+            add_metric("llm_achieved_tokens_per_minute", "gauge", "Tokens processed over the last 60 seconds.",
+                       [({"deployment": d}, self._achieved_tpm(d)) for d in deployments])
+            add_metric("llm_tokens_per_minute_limit", "gauge", "Tokens per minute quota of the deployment.",
+                       [({"deployment": d}, limit) for d, limit in sorted(self.tpm_limits.items())])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Writes the metrics to a .prom file (atomically, for the node_exporter textfile collector)."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+
+_registry = MetricsRegistry()
+
+def get_registry() -> MetricsRegistry:
+    """Returns the process-wide metrics registry."""
+    return _registry
+
+
+@contextmanager
+def trace_job(path: str, job: str = None):
+    """Records every call made inside the block to a JSONL trace file."""
+    _registry.start_trace(path, job or os.path.splitext(os.path.basename(path))[0])
+    try:
+        yield _registry
+    finally:
+        _registry.stop_trace()
@@ -12,6 +12,13 @@ most popular subreddits. Thus, data from smaller subreddits must be manually scr
 Be extremely careful of rate-limiting (depending on how much data it retrieves, you can get 
 blocked after making just 1 request!! In that case, your only option is to wait it out...)
 
+Every (company, name variation, comments/posts) search is a separate query stream. The streams
+take turns under one PullPush budget of requests_per_minute (3 by default, the same average as
+the old 10-30 sec sleeps, so a request takes as long as before; the savings come from streams
+that stop as soon as they run dry). When a request gets blocked, all of them pause for a while
+(longer after each block in a row), the budget is halved, and they resume where they left off.
+The budget creeps back up to requests_per_minute after a run of successful requests.
+
 To run this script, create a new configuration file (.json) and then run the command
 'python reddit_scraper.py <config path>'. If no path is provided, default settings will be used.
 
@@ -26,14 +33,26 @@ import sys
 import os
 import time
 import json
-import requests
+import asyncio
 import pandas as pd
-from random import randint
 from typing import List
 from utils import *
+from fetch_engine import FetchEngine, HostPolicy, DEFAULT_HOST_POLICIES, PULLPUSH_REQUESTS_PER_MINUTE
+from http_client import close_sessions
+from review_store import get_default_review_store
 
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Compact dtypes of the columns that are read back most often
+READ_DTYPES = {
+    'subreddit': 'category',
+    'subreddit_type': 'category',
+    'search_term': 'category',
+    'score': 'Int32',
+    'num_comments': 'Int32',
+    'created_utc': 'Int64'
+}
+
 
 class Config:
     """Loads in configuration settings for Reddit scraping setup.
@@ -46,6 +65,8 @@ class Config:
         fetch_newest (bool): Indicate which direction in time to start scraping.
         n_stop (int): Max number of comments/posts to scrape per site.
         choice (int): 0 - Comments only, 1 - Posts only, 2 - Both comments and posts
+        requests_per_minute (float): Average number of PullPush requests per minute, shared by every query
+        stream (optional, defaults to PULLPUSH_REQUESTS_PER_MINUTE).
     """
     def __init__(self, config_path):
         with open(config_path, 'r') as file:
@@ -61,6 +82,7 @@ class Config:
         self.fetch_newest = config['fetch_newest']
         self.n_stop = config['n_stop']
         self.choice = config['choice']
+        self.requests_per_minute = config.get('requests_per_minute', PULLPUSH_REQUESTS_PER_MINUTE)
 
     @staticmethod
     def validate_config(config):
@@ -69,6 +91,83 @@ class Config:
         for field in required_fields:
             if field not in config:
                 raise ValueError(f"Missing required config field: {field}")
+        requests_per_minute = config.get('requests_per_minute', PULLPUSH_REQUESTS_PER_MINUTE)
+        if isinstance(requests_per_minute, bool) or not isinstance(requests_per_minute, (int, float)) or requests_per_minute <= 0:
+            raise ValueError(f"Invalid requests_per_minute: {requests_per_minute}. Use a number > 0.")
+
+
+class PullPushBlocked(Exception):
+    """Raised when PullPush refuses a request (typically an empty or HTML body instead of JSON)."""
+
+
+class BlockBackoff:
+    """Pauses every PullPush request after a block, doubling the pause for each block in a row, and
+    lowers the host's requests per minute budget. The budget goes back up after a run of successes.
+
+    Attributes:
+        initial_delay (float): Pause after the first block, in seconds.
+        max_delay (float): Longest pause, in seconds.
+        max_blocks (int): Number of blocks in a row after which the streams give up.
+        rate_factor (float): The budget is multiplied by this after a block, and divided by it on recovery.
+        min_rate (float): Lowest budget, in requests per minute.
+        recovery_requests (int): Number of successful requests in a row before the budget is raised again.
+        blocks_in_a_row (int): Number of blocks since the last successful request.
+    """
+    def __init__(self, initial_delay: float = 60, max_delay: float = 30 * 60, max_blocks: int = 10,
+                 rate_factor: float = 0.5, min_rate: float = 0.5, recovery_requests: int = 20):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_blocks = max_blocks
+        self.rate_factor = rate_factor
+        self.min_rate = min_rate
+        self.recovery_requests = recovery_requests
+        self.blocks_in_a_row = 0
+        self.successes_in_a_row = 0
+
+    def on_block(self, scheduler, host: str):
+        """Pushes back the next request to the host. Returns the pause in seconds, or None to give up."""
+        self.blocks_in_a_row += 1
+        self.successes_in_a_row = 0
+        if self.blocks_in_a_row > self.max_blocks:
+            return None
+        rate = scheduler.get_rate(host)
+        if rate is not None:
+            scheduler.set_rate(host, max(self.min_rate, rate * self.rate_factor))
+        delay = min(self.max_delay, self.initial_delay * 2 ** (self.blocks_in_a_row - 1))
+        scheduler.defer(host, delay)
+        return delay
+
+    def on_success(self, scheduler, host: str):
+        self.blocks_in_a_row = 0
+        self.successes_in_a_row += 1
+        rate = scheduler.get_rate(host)
+        if rate is not None and self.successes_in_a_row % self.recovery_requests == 0:
+            scheduler.set_rate(host, rate / self.rate_factor)  # Capped at the policy's rate
+
+
+class QueryStream:
+    """Progress of the requests for one (company, name variation, endpoint)."""
+    def __init__(self, name: str, name_variation: str, data_type: str):
+        self.name = name
+        self.name_variation = name_variation
+        self.data_type = data_type
+        self.dataset = get_dataset_name(name, data_type)
+        self.pages = 0
+        self.collected = 0
+        self.status = 'pending'
+
+    def __str__(self):
+        return f"{self.data_type} | {self.name} | '{self.name_variation}'"
+
+
+def parse_page(response) -> list:
+    """Returns the items of a PullPush response. Raises PullPushBlocked if the request was refused."""
+    if response.status_code != 200:
+        raise PullPushBlocked(f"HTTP {response.status_code}")
+    try:
+        return response.json()['data']
+    except (ValueError, KeyError) as e:  # e.g. "Expecting value: line 1 column 1 (char 0)"
+        raise PullPushBlocked(str(e))
 
 
 def scrape_data(names_list: List[str], output_folder: str, n_stop: int, fetch_newest: bool, data_type: str):
@@ -88,46 +187,168 @@ def scrape_data(names_list: List[str], output_folder: str, n_stop: int, fetch_ne
         (essentially the reverse direction in time).
         data_type: Indicates whether the data is comments or posts.
     """
-    print(f"\n############################\nSTARTING {data_type.upper()} SCRAPER\n############################\n")
-    for name in names_list:
-        output_path = os.path.join(output_folder, f"{name}.csv")
-
-        if os.path.exists(output_path):
-            df = pd.read_csv(output_path)
-        else:
-            df = pd.DataFrame()
-        
-        while len(df) <= n_stop and n_stop != 0:        
-            merge_df = pd.DataFrame()
-            for name_variation in get_name_variations(name):
-                request_url = prepare_request(df, name_variation, fetch_newest, data_type)
-                request_object = requests.get(request_url).json()
-                time.sleep(randint(10, 30))  # Wait between 10-30 sec between each request
-                new_df = pd.DataFrame.from_dict(request_object['data'])
-                new_df['search_term'] = name_variation
-                merge_df = pd.concat([merge_df, new_df], ignore_index=True)
-                
-            if not merge_df.empty:
-                df = pd.concat([df, merge_df], ignore_index=True).drop_duplicates(subset='id', keep="last")
-                df.to_csv(output_path, index=False)
-                print(f'[IN-PROGRESS] {len(merge_df)} {data_type} collected from {name}. {len(df)} collected in total.')
-            else:
-                print(f"[✓] No new data for {name}. {len(df)} collected in total.")
-                break
-
-        print(f'[✓] Max {data_type} collected from {name}. {len(df)} collected in total.\n')
-    return
-
-
-def prepare_request(df, name_variation, fetch_newest, data_type):
-    if df.empty or df[df['search_term'] == name_variation].empty:
+    return asyncio.run(scrape_data_async(names_list, [(output_folder, data_type)], n_stop, fetch_newest))
+
+
+def get_pullpush_policies(requests_per_minute: float) -> dict:
+    """Returns the default host policies with the PullPush budget set to requests_per_minute."""
+    policy = DEFAULT_HOST_POLICIES['api.pullpush.io']
+    return {**DEFAULT_HOST_POLICIES,
+            'api.pullpush.io': HostPolicy(policy.min_delay, policy.max_delay, policy.max_concurrency,
+                                          requests_per_minute=requests_per_minute, burst=policy.burst)}
+
+
+async def scrape_data_async(names_list: List[str], outputs: list, n_stop: int, fetch_newest: bool, engine=None,
+                            requests_per_minute: float = None):
+    """
+    Scrapes the comments and/or posts of every company at once. Each (company, name variation,
+    endpoint) is a separate query stream, and all the streams share the engine's api.pullpush.io
+    budget (requests_per_minute, one request in flight), so they take turns instead of waiting for
+    each other to finish. The time per request is set by the budget alone, the run gets shorter
+    because streams stop as soon as they run dry. When PullPush blocks a request, every stream
+    pauses (longer for each block in a row), the budget is halved, and the streams resume where
+    they left off.
+
+    Args:
+        names_list: List of names to iterate through.
+        outputs: List of (output_folder, data_type) to scrape, e.g. [(comments_folder, "comments")].
+        n_stop: Stop collecting more items from a company after n_stop items have been collected in total.
+        fetch_newest: See scrape_data.
+        engine (FetchEngine): Optional engine to share with other scrapers. A new one is used if None.
+        requests_per_minute: PullPush budget of a new engine. Defaults to PULLPUSH_REQUESTS_PER_MINUTE.
+        A shared engine keeps its own api.pullpush.io policy.
+
+    Returns:
+        List of QueryStream with the progress of every stream.
+    """
+    if engine is None:
+        async with FetchEngine(host_policies=get_pullpush_policies(requests_per_minute or PULLPUSH_REQUESTS_PER_MINUTE)) as engine:
+            return await scrape_data_async(names_list, outputs, n_stop, fetch_newest, engine)
+
+    store = get_default_review_store()
+    streams, totals, output_paths = [], {}, {}
+    for output_folder, data_type in outputs:
+        for name in names_list:
+            output_path = os.path.join(output_folder, f"{name}.csv")
+            dataset = get_dataset_name(name, data_type)
+
+            # Data collected before the store existed
+            if store.count(dataset) == 0 and os.path.exists(output_path):
+                store.import_csv(dataset, output_path, id_column='id', keep='last')
+            totals[dataset] = store.count(dataset)
+            if totals[dataset] and not store.has_cursors(dataset):
+                store.rebuild_cursors(dataset, 'search_term', 'created_utc', 'id')
+            output_paths[dataset] = output_path
+            streams += [QueryStream(name, name_variation, data_type) for name_variation in get_name_variations(name)]
+
+    print(f"\n############################\nSTARTING REDDIT SCRAPER ({len(streams)} query streams)\n############################\n")
+    updated = set()
+    backoff = BlockBackoff()  # Shared, since a block applies to every request to PullPush
+    tasks = [asyncio.ensure_future(collect_stream(engine, store, stream, totals, updated, n_stop, fetch_newest, backoff))
+             for stream in streams]
+    try:
+        await asyncio.gather(*tasks)
+        # Drops the older versions of re-fetched items, only in the datasets this run appended to
+        removed = store.compact(sorted(updated)) if updated else 0
+        if removed:
+            print(f"Removed {removed} superseded rows from the review store.")
+    except PullPushBlocked as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+    finally:
+        for task in tasks:  # Only still running after a block or Ctrl+C
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for stream in streams:
+            if stream.status in ('pending', 'running'):
+                stream.status = 'stopped'
+        for dataset in updated:  # The CSVs are only rewritten once per run, even if the scraper gets blocked
+            store.export_csv(dataset, output_paths[dataset])
+        print("\n[✓] Query streams:")
+        for stream in streams:
+            print(f"    {stream}: {stream.status}, {stream.pages} pages, {stream.collected} new {stream.data_type}.")
+    return streams
+
+
+async def collect_stream(engine, store, stream, totals, updated, n_stop, fetch_newest, backoff):
+    """Requests the pages of one query stream until it runs out of new items or its company reaches n_stop."""
+    stream.status = 'running'
+    try:
+        while totals[stream.dataset] <= n_stop and n_stop != 0:
+            cursor = store.get_cursor(stream.dataset, stream.name_variation)
+            request_url = prepare_request(cursor, stream.name_variation, fetch_newest, stream.data_type)
+            response = await engine.fetch(request_url)  # Paced by the engine's api.pullpush.io policy
+            try:
+                items = parse_page(response)
+            except PullPushBlocked as e:
+                if engine.cache is not None:
+                    engine.cache.delete(request_url)  # Do not replay the error page
+                delay = backoff.on_block(engine.scheduler, engine.scheduler.get_host(request_url))
+                if delay is None:
+                    stream.status = 'blocked'
+                    raise PullPushBlocked(f"Server requests were still blocked after {backoff.max_blocks} pauses. Try again in a few minutes.")
+                print(f"[BLOCKED] {stream}: {e}. Pausing PullPush requests for {delay:.0f} sec.")
+                continue
+            backoff.on_success(engine.scheduler, engine.scheduler.get_host(request_url))
+            stream.pages += 1
+
+            if not items:
+                stream.status = 'done'
+                print(f"[✓] No new data for {stream}. {totals[stream.dataset]} collected from {stream.name} in total.")
+                return
+            new_df = pd.DataFrame.from_dict(items)
+            new_df['search_term'] = stream.name_variation
+            n_new = store.append(stream.dataset, new_df, id_column='id', keep='last')
+            store.update_cursors(stream.dataset, new_df, 'search_term', 'created_utc', 'id')
+            updated.add(stream.dataset)
+            totals[stream.dataset] += n_new
+            stream.collected += n_new
+            print(f'[IN-PROGRESS] {stream}: page {stream.pages}, {n_new} new. {totals[stream.dataset]} collected from {stream.name} in total.')
+
+            if n_new == 0 and store.get_cursor(stream.dataset, stream.name_variation) == cursor:
+                stream.status = 'done'  # The page only had items we already have, and the cursor did not move
+                return
+        stream.status = 'max reached'
+    except PullPushBlocked:
+        raise  # Stops every stream
+    except Exception as e:
+        stream.status = f'error: {e}'
+        print(f"Error: {stream}: {e}", file=sys.stderr)
+
+
+def get_dataset_name(name: str, data_type: str) -> str:
+    """Returns the name of the review store dataset holding a company's comments or posts."""
+    return f"reddit_{data_type}/{name}"
+
+
+def iter_collected_data(name: str, data_type: str, columns: List[str] = None, batch_size: int = 50000):
+    """ Yields the comments or posts collected for a company as DataFrames of up to batch_size rows,
+    with the compact dtypes of READ_DTYPES, so memory use does not grow with the company's history.
+
+    Args:
+        name: Company name, as in names_list.
+        data_type: Indicates whether the data is comments or posts.
+        columns: Columns to keep (e.g. ['id', 'body', 'created_utc']). Defaults to every column.
+        batch_size: Max number of rows per DataFrame.
+    """
+    return get_default_review_store().iter_batches(get_dataset_name(name, data_type), columns=columns,
+                                                   dtype=READ_DTYPES, batch_size=batch_size)
+
+
+def prepare_request(cursor, name_variation, fetch_newest, data_type):
+    """ Builds the PullPush search URL of the next page of a name variation.
+
+    Args:
+        cursor: Time range already collected for the name variation (see ReviewStore.get_cursor), or None.
+        name_variation: Search term.
+        fetch_newest: If True, fetch what came after the newest item collected, otherwise what came before the oldest.
+        data_type: Indicates whether the data is comments or posts.
+    """
+    if cursor is None:
         bookmark = int(time.time())
+    elif fetch_newest:
+        bookmark = int(cursor['newest_time'])
     else:
-        bookmark = df[df['search_term'] == name_variation]['created_utc'].astype(int)
-        if fetch_newest:
-            bookmark = bookmark.sort_values(ascending=False).iloc[0]
-        else:
-            bookmark = bookmark.sort_values(ascending=True).iloc[0]
+        bookmark = int(cursor['oldest_time'])
 
     endpoint = "comment" if data_type == "comments" else "submission"
     direction = "after" if fetch_newest else "before"
@@ -138,20 +359,21 @@ def prepare_request(df, name_variation, fetch_newest, data_type):
 def main(config_file):
     try:
         config = Config(config_file)
+        outputs = []
+        if config.choice in [0, 2]:
+            outputs.append((config.comments_output_folder, "comments"))
+        if config.choice in [1, 2]:
+            outputs.append((config.submissions_output_folder, "posts"))
 
         with spinner(title='In progress...'):
-            if config.choice in [0, 2]:
-                scrape_data(config.names_list, config.comments_output_folder, config.n_stop, config.fetch_newest, "comments")
-            if config.choice in [1, 2]:
-                scrape_data(config.names_list, config.submissions_output_folder, config.n_stop, config.fetch_newest, "posts")
+            asyncio.run(scrape_data_async(config.names_list, outputs, config.n_stop, config.fetch_newest,
+                                          requests_per_minute=config.requests_per_minute))
 
     except Exception as e:
-        if str(e) == "Expecting value: line 1 column 1 (char 0)":
-            print("ERROR: Server request was blocked due to a high frequency of requests made within a short period of time. Try again in a few minutes or edit the waiting logic to avoid overloading the server.", file=sys.stderr)
-        else:
-            print(f"Error: {e}", file=sys.stderr)
+        print(f"Error: {e}", file=sys.stderr)
         
     finally:
+        close_sessions()
         print("[✓] Execution complete, performing cleanup.")
 
 
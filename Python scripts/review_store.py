@@ -0,0 +1,353 @@
+"""
+Append-only on-disk store for scraped reviews, posts and comments.
+
+The scrapers used to re-read a company's whole CSV, concat the new page and rewrite the whole
+file after every page, so the I/O of a run grew quadratically with the company's history. Here
+each page is appended as new rows of a SQLite database instead, keyed by (dataset, id) so
+checking which ids are already stored is an index lookup rather than a scan. A dataset holds
+the rows of one source and company, e.g. 'trustpilot/playlistpush' or 'reddit_comments/groover'.
+
+Appends never rewrite existing rows. With keep='first', ids that are already stored are skipped.
+With keep='last', every row is appended and the latest version of an id wins on read, and the
+superseded versions are removed by compact(). read() returns a dataset as a DataFrame, and
+import_csv()/export_csv() convert from and to the CSV files the notebooks use, so the CSVs only
+have to be written once, at the end of a run. iter_batches(), import_csv() and export_csv() work
+through a dataset a batch of rows at a time, so their memory use does not grow with the dataset.
+
+Each dataset can also keep cursors: for every value of a key column (e.g. the Reddit search
+term), the oldest and newest time stored so far and the ids at both ends. They are widened as
+batches are appended, so finding where to resume is a primary key lookup instead of a scan of
+the dataset.
+
+The default store lives at '.review_store/reviews.sqlite' in the repo root and can be moved by
+setting the SCRAPER_REVIEW_STORE_PATH environment variable.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import pandas as pd
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MAX_QUERY_IDS = 900  # Stays under SQLite's limit on the number of query parameters
+DEFAULT_BATCH_SIZE = 50000
+
+# Rows that have not been replaced by a newer version of the same id
+_LATEST_ROWS = ("SELECT seq, id, data FROM rows WHERE dataset = ? AND seq > ? AND NOT EXISTS "
+                "(SELECT 1 FROM rows AS newer WHERE newer.dataset = rows.dataset AND newer.id = rows.id AND newer.seq > rows.seq) "
+                "ORDER BY seq LIMIT ?")
+
+
+def _to_json(value):
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    return str(value)  # Timestamps and other objects are stored like to_csv writes them
+
+
+_encoder = json.JSONEncoder(default=_to_json)
+
+def _encode_rows(df):
+    """Yields each row of df as a JSON object string. Much faster than json.dumps over df.to_dict('records')."""
+    columns = [str(column) for column in df.columns]
+    # tolist() converts whole columns to Python objects at once, except datetimes, which would become ints
+    values = [df.iloc[:, i].astype(object).tolist() if df.dtypes.iloc[i].kind == 'M' else df.iloc[:, i].tolist()
+              for i in range(len(columns))]
+    for row in zip(*values):
+        yield _encoder.encode(dict(zip(columns, row)))
+
+
+class ReviewStore:
+    """Persistent append-only row store backed by SQLite.
+
+    Attributes:
+        path (str): Location of the SQLite database file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS rows (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                dataset TEXT NOT NULL,
+                id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                added_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_rows_dataset_id ON rows(dataset, id)")  # Entries include seq (the rowid)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_rows_dataset_seq ON rows(dataset, seq)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS datasets (
+                dataset TEXT PRIMARY KEY,
+                id_column TEXT,
+                column_names TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cursors (
+                dataset TEXT NOT NULL,
+                key TEXT NOT NULL,
+                oldest_time REAL NOT NULL,
+                oldest_id TEXT NOT NULL,
+                newest_time REAL NOT NULL,
+                newest_id TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (dataset, key)
+            )""")
+        self._conn.commit()
+
+    def has_ids(self, dataset: str, ids) -> set:
+        """Returns the subset of ids that are already stored in the dataset."""
+        ids = list(dict.fromkeys(str(row_id) for row_id in ids))
+        found = set()
+        with self._lock:
+            for i in range(0, len(ids), MAX_QUERY_IDS):
+                chunk = ids[i:i + MAX_QUERY_IDS]
+                rows = self._conn.execute(
+                    f"SELECT DISTINCT id FROM rows WHERE dataset = ? AND id IN ({','.join('?' * len(chunk))})",
+                    (dataset, *chunk))
+                found.update(row[0] for row in rows)
+        return found
+
+    def append(self, dataset: str, df: pd.DataFrame, id_column: str = None, keep: str = 'first') -> int:
+        """ Appends a batch of rows to a dataset.
+
+        Args:
+            dataset: Name of the dataset, e.g. 'trustpilot/<company>'.
+            df: Rows to append.
+            id_column: Column holding the row ids. If None, the DataFrame index is used (and restored by read()).
+            keep: 'first' skips ids that are already stored. 'last' appends every row, and the latest version
+            of an id replaces the older ones.
+
+        Returns:
+            Number of ids that were not in the dataset before.
+        """
+        if keep not in ('first', 'last'):
+            raise ValueError(f"Invalid keep value: {keep}. Use 'first' or 'last'.")
+        if df.empty:
+            return 0
+        ids = (df[id_column] if id_column is not None else df.index.to_series()).astype(str)
+        unique = ~ids.duplicated(keep=keep).to_numpy()
+        df, ids = df[unique], ids[unique]
+        existing = self.has_ids(dataset, ids)
+        new = ~ids.isin(existing).to_numpy()
+        if keep == 'first':
+            df, ids = df[new], ids[new]
+
+        now = time.time()
+        rows = [(dataset, row_id, data, now) for row_id, data in zip(ids, _encode_rows(df))]
+        with self._lock:
+            column_names = self._merge_column_names(dataset, df.columns)
+            self._conn.executemany("INSERT INTO rows (dataset, id, data, added_at) VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO datasets (dataset, id_column, column_names, updated_at) VALUES (?, ?, ?, ?)",
+                (dataset, id_column, column_names, now))
+            self._conn.commit()
+        return int(new.sum())
+
+    def _merge_column_names(self, dataset, columns):
+        """Adds new columns to the dataset's column list, so every batch read back has the same columns."""
+        row = self._conn.execute("SELECT column_names FROM datasets WHERE dataset = ?", (dataset,)).fetchone()
+        column_names = json.loads(row[0]) if row is not None else []
+        known = set(column_names)
+        column_names += [str(column) for column in columns if str(column) not in known]
+        return json.dumps(column_names)
+
+    def _get_dataset_info(self, dataset):
+        with self._lock:
+            row = self._conn.execute("SELECT id_column, column_names FROM datasets WHERE dataset = ?", (dataset,)).fetchone()
+        if row is None:
+            return None
+        return {"id_column": row[0], "column_names": json.loads(row[1])}
+
+    def count(self, dataset: str) -> int:
+        """Returns the number of distinct ids in the dataset."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(DISTINCT id) FROM rows WHERE dataset = ?", (dataset,)).fetchone()[0]
+
+    def iter_batches(self, dataset: str, columns: list = None, dtype: dict = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        """ Yields the latest version of every row of the dataset, in the order they were added, as DataFrames
+        of up to batch_size rows. Memory use depends on batch_size, not on the size of the dataset.
+
+        Args:
+            dataset: Name of the dataset.
+            columns: Columns to keep (like usecols). Defaults to every column.
+            dtype: Column -> dtype applied to each batch, e.g. {'score': 'int32', 'subreddit': 'category'}.
+            batch_size: Max number of rows per DataFrame.
+        """
+        info = self._get_dataset_info(dataset)
+        if info is None:
+            return
+        columns = columns or info["column_names"]
+        last_seq = 0
+        while True:
+            with self._lock:  # Each batch is its own query, so appends can run between batches
+                rows = self._conn.execute(_LATEST_ROWS, (dataset, last_seq, batch_size)).fetchall()
+            if not rows:
+                return
+            last_seq = rows[-1][0]
+            df = pd.DataFrame([json.loads(data) for _, _, data in rows], columns=columns)
+            if info["id_column"] is None:  # Ids were the index
+                df.index = [row_id for _, row_id, _ in rows]
+            yield df.astype({column: dtype[column] for column in df.columns if column in dtype}) if dtype else df
+
+    def read(self, dataset: str, columns: list = None, dtype: dict = None) -> pd.DataFrame:
+        """Returns the latest version of every row of the dataset, in the order they were added. See iter_batches."""
+        batches = list(self.iter_batches(dataset, columns, dtype))
+        if not batches:
+            return pd.DataFrame()
+        if len(batches) == 1:
+            return batches[0]
+        df = pd.concat(batches)
+        if dtype:  # Categories that differ between batches were concatenated as object
+            df = df.astype({column: dtype[column] for column in df.columns if column in dtype})
+        return df
+
+    def datasets(self) -> list:
+        """Returns the names of the stored datasets."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT dataset FROM datasets ORDER BY dataset")]
+
+    def import_csv(self, dataset: str, path: str, id_column: str = None, keep: str = 'first',
+                   chunksize: int = DEFAULT_BATCH_SIZE) -> int:
+        """ Appends the rows of a CSV written by a scraper (or by export_csv) to a dataset, chunksize rows at a time.
+
+        Args:
+            dataset: Name of the dataset.
+            path: CSV file path.
+            id_column: Column holding the row ids. If None, the first column is read as the index and used as the id.
+            keep: See append().
+            chunksize: Number of CSV rows read and appended at a time.
+
+        Returns:
+            Number of ids that were not in the dataset before.
+        """
+        n_new = 0
+        for chunk in pd.read_csv(path, index_col=0 if id_column is None else None, chunksize=chunksize):
+            n_new += self.append(dataset, chunk, id_column=id_column, keep=keep)
+        return n_new
+
+    def export_csv(self, dataset: str, path: str, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        """ Writes the dataset to a CSV file, batch by batch, with the ids as first column if they are the index.
+
+        Returns:
+            Number of rows written.
+        """
+        info = self._get_dataset_info(dataset)
+        index = info is not None and info["id_column"] is None
+        n_rows = 0
+        for df in self.iter_batches(dataset, batch_size=batch_size):
+            df.to_csv(path, index=index, mode='w' if n_rows == 0 else 'a', header=n_rows == 0)
+            n_rows += len(df)
+        return n_rows
+
+    def compact(self, datasets=None, vacuum: bool = False) -> int:
+        """ Removes the superseded versions of rows appended with keep='last' and returns how many were removed.
+
+        Args:
+            datasets: Name or list of names of the datasets to compact. Every dataset is compacted if None.
+            vacuum: If True, also VACUUM the database to give the freed space back to the file system. This
+            rewrites the whole file and blocks every other connection while it runs, so keep it for maintenance.
+        """
+        query = "DELETE FROM rows WHERE seq NOT IN (SELECT MAX(seq) FROM rows {where} GROUP BY dataset, id) {and_where}"
+        if isinstance(datasets, str):
+            datasets = [datasets]
+        with self._lock:
+            if datasets is None:
+                removed = self._conn.execute(query.format(where="", and_where="")).rowcount
+            else:
+                removed = sum(self._conn.execute(query.format(where="WHERE dataset = ?", and_where="AND dataset = ?"),
+                                                 (dataset, dataset)).rowcount for dataset in datasets)
+            self._conn.commit()
+            if vacuum:
+                self._conn.execute("VACUUM")
+        return removed
+
+    def get_cursor(self, dataset: str, key: str):
+        """ Returns the time range of the rows stored under a key (e.g. a search term), or None if there are none.
+
+        Returns:
+            Dict with the oldest/newest times and the ids of the rows at both ends:
+            {"oldest_time": ..., "oldest_id": ..., "newest_time": ..., "newest_id": ...}
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT oldest_time, oldest_id, newest_time, newest_id FROM cursors WHERE dataset = ? AND key = ?",
+                (dataset, str(key))).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('oldest_time', 'oldest_id', 'newest_time', 'newest_id'), row))
+
+    def has_cursors(self, dataset: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM cursors WHERE dataset = ? LIMIT 1", (dataset,)).fetchone() is not None
+
+    def update_cursors(self, dataset: str, df: pd.DataFrame, key_column: str, time_column: str, id_column: str):
+        """ Widens the cursors of a dataset with a batch of rows, e.g. right after appending it.
+
+        Args:
+            dataset: Name of the dataset.
+            df: Rows of the batch.
+            key_column: Column the cursors are kept by (e.g. 'search_term').
+            time_column: Numeric time column (e.g. 'created_utc'). Rows without a time are ignored.
+            id_column: Column holding the row ids.
+        """
+        batch = pd.DataFrame({'key': df[key_column].astype(str), 'time': pd.to_numeric(df[time_column], errors='coerce'),
+                              'id': df[id_column].astype(str)}).dropna(subset=['time'])
+        if batch.empty:
+            return
+        grouped = batch.sort_values('time', kind='stable').groupby('key', sort=False)
+        oldest, newest = grouped.first(), grouped.last()
+        now = time.time()
+        rows = [(dataset, key, float(oldest.at[key, 'time']), oldest.at[key, 'id'], float(newest.at[key, 'time']),
+                 newest.at[key, 'id'], now) for key in oldest.index]
+        with self._lock:
+            # SET expressions all see the stored values, so each end only moves if the batch goes past it
+            self._conn.executemany("""
+                INSERT INTO cursors (dataset, key, oldest_time, oldest_id, newest_time, newest_id, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(dataset, key) DO UPDATE SET
+                    oldest_id = CASE WHEN excluded.oldest_time < oldest_time THEN excluded.oldest_id ELSE oldest_id END,
+                    oldest_time = MIN(oldest_time, excluded.oldest_time),
+                    newest_id = CASE WHEN excluded.newest_time > newest_time THEN excluded.newest_id ELSE newest_id END,
+                    newest_time = MAX(newest_time, excluded.newest_time),
+                    updated_at = excluded.updated_at""", rows)
+            self._conn.commit()
+
+    def rebuild_cursors(self, dataset: str, key_column: str, time_column: str, id_column: str):
+        """Recomputes the cursors of a dataset from its stored rows (one pass), e.g. after import_csv."""
+        with self._lock:
+            self._conn.execute("DELETE FROM cursors WHERE dataset = ?", (dataset,))
+            self._conn.commit()
+        for batch in self.iter_batches(dataset, columns=[key_column, time_column, id_column]):
+            self.update_cursors(dataset, batch.dropna(subset=[key_column]), key_column, time_column, id_column)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def get_default_review_store() -> ReviewStore:
+    """Returns the process-wide review store, creating it on first use."""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            path = os.getenv("SCRAPER_REVIEW_STORE_PATH", os.path.join(parent_dir, ".review_store", "reviews.sqlite"))
+            _default_store = ReviewStore(path)
+        return _default_store
+
+
+def set_default_review_store(store: ReviewStore):
+    """Replaces the process-wide review store, e.g. to change its location."""
+    global _default_store
+    with _default_store_lock:
+        _default_store = store
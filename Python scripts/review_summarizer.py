@@ -0,0 +1,241 @@
+"""
+Map-reduce summarizer for company reviews and social media posts.
+
+Instead of truncating a company's reviews to fit in one prompt (as chop_input does), the reviews
+are split into token-bounded chunks that are summarized in parallel under the deployment's rate
+limiter (map). The partial summary/aspect JSON objects are then merged in groups, level by
+level, until a single summary is left (reduce). Every review is read by the model at least once;
+chunks that keep failing are re-asked a few times and then reported in the result's
+missing_chunks. If on_delta is given, the final request (the last merge, or the only map
+request) is streamed, so the summary can be shown as it is written. When a streamed answer is
+rejected and re-asked, on_delta(None) is called first so the caller can discard the text so far.
+
+Usage:
+    result = summarize_reviews('broadjam', reviews, get_default_model_config(), get_default_api_config())
+    summarize_companies({'broadjam': reviews}, output_path, model_config, api_config)
+"""
+
+import os
+import json
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from azure_openai_cookbook import (AzureOpenAIConfig, AzureAPIConfig, get_completion_json, stream_completion_json, get_rate_limiter, 
+                                   get_tokenizer, get_response_cost, count_tokens_batch, estimate_num_tokens_from_str, pack_token_batches)
+
+SUMMARY_KEYS = ["summary", "positive_aspects", "negative_aspects", "neutral_aspects"]
+
+SUMMARY_PROMPT = """
+Analyze these social media posts and comments about a music PR/playlist promotion company named {company}. Generate a brief paragraph-long summary that focuses on customer opinions/concerns/experiences regarding {company}. Additionally, list out the most frequently mentioned aspects about the company, categorized as positive, negative, or neutral. Each aspect should be summarized in 1-2 words, ensuring that synonyms or similar variants are consolidated under a single term that best represents the sentiment expressed across mentions. If an aspect could be interpreted in multiple ways (positive, negative, neutral), categorize it based on the overall sentiment it most commonly aligns with in the context of these reviews. Avoid listing the same aspect or closely related aspects (including synonyms or near-synonyms) in more than one category. Return a JSON object consisting of "summary", "positive_aspects", "negative_aspects", and "neutral_aspects".
+
+Please note:
+- Keep in mind that some users may refer to multiple different services in the same post. Thus, only consider parts of the text that are explicitly referring to {company}. Ignore mentions of other services or irrelevant discussions.
+- Do not mention other companies, services, or trademark names, directly in your summary.
+- Avoid fabricating information or introducing unrelated topics.
+- Avoid being overly vague/redundant in your answer. If there is not enough data, keep your summary brief.
+
+Posts and comments:
+"""
+
+MERGE_PROMPT = """
+Below are several JSON summaries, each written from a different subset of the social media posts and comments about a music PR/playlist promotion company named {company}. Merge them into a single JSON object with the same keys: "summary", "positive_aspects", "negative_aspects", and "neutral_aspects". The merged summary should be a brief paragraph that reflects the opinions/concerns/experiences across all subsets, giving more weight to points that come up in several of them. Consolidate synonyms or similar aspects under a single term, and avoid listing the same aspect in more than one category. Do not introduce information that is not in the summaries.
+
+Summaries:
+"""
+
+
+def split_into_chunks(reviews: list, chunk_tokens: int, model_config: AzureOpenAIConfig):
+    """
+    Splits reviews into chunks of at most chunk_tokens tokens, keeping reviews whole where possible.
+    Reviews longer than chunk_tokens are split into several pieces so that nothing is dropped.
+    Returns a list of chunk strings.
+    """
+    encoding = get_tokenizer(model_config)
+    pieces = []
+    for review, num_tokens in zip(reviews, count_tokens_batch(reviews, model_config)):
+        if num_tokens <= chunk_tokens:
+            pieces.append((review, num_tokens))
+        else:
+            tokens = encoding.encode(review)
+            pieces.extend((encoding.decode(tokens[i:i + chunk_tokens]), len(tokens[i:i + chunk_tokens]))
+                          for i in range(0, len(tokens), chunk_tokens))
+
+    token_counts = pd.Series([num_tokens + 1 for _, num_tokens in pieces], dtype='int64')  # +1 for the separating newline
+    batches = pack_token_batches(token_counts, chunk_tokens, len(pieces) or 1)
+    return ["\n".join(pieces[i][0] for i in batch) for batch in batches]
+
+
+def _parse_summary(response):
+    """Returns the summary JSON of a response, or None if it is missing or malformed."""
+    if not response:
+        return None
+    try:
+        summary = json.loads(response.choices[0].message.content)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(summary, dict) or "summary" not in summary:
+        return None
+    return {key: summary.get(key, [] if key != "summary" else "") for key in SUMMARY_KEYS}
+
+
+def summarize_reviews(company: str, reviews: list, model_config: AzureOpenAIConfig, api_config: AzureAPIConfig,
+                      chunk_tokens: int = 16000, merge_fan_in: int = 8, max_workers: int = 8, use_cache: bool = True,
+                      on_delta=None, max_attempts: int = 3):
+    """ Summarizes all reviews of a company, however many there are.
+
+    Params:
+    company: Name of the company, used in the prompts
+    reviews: List of review/post/comment texts
+    model_config: Azure openAI model configuration
+    api_configuration: Azure openAI API configuration
+    chunk_tokens: Max number of review tokens per map request. Smaller chunks mean more requests in parallel.
+    merge_fan_in: Max number of partial summaries merged by a single request
+    max_workers: Max number of requests in flight at the same time
+    use_cache: If False, bypass the on-disk completion cache
+    on_delta: Optional callback that receives the text of the final request as it is streamed. It is
+              called with None before a re-ask, meaning the text received so far was rejected.
+    max_attempts: Max number of times each map/merge request is sent before giving up on it
+
+    Returns:
+    Dict with "company", the four summary keys, "num_chunks", "missing_chunks" and "cost".
+    "missing_chunks" lists the chunks that still failed after max_attempts, so an empty list means
+    every review is covered. Raises RuntimeError if a merge still fails after max_attempts, or if the
+    partial summaries are too long to be merged within the input budget.
+    """
+    reviews = [review for review in reviews if isinstance(review, str) and review.strip()]
+    map_prompt = SUMMARY_PROMPT.format(company=company)
+    merge_prompt = MERGE_PROMPT.format(company=company)
+    budget = min(model_config.max_input, model_config.tokens_per_minute_limit - model_config.max_output)
+    chunk_tokens = min(chunk_tokens, budget - estimate_num_tokens_from_str(map_prompt, model_config))
+    rate_limiter = get_rate_limiter(model_config)
+    total_api_cost = 0.0
+    streamed = False
+
+    def complete(prompt, use_cache):
+        return prompt, get_completion_json(prompt, model_config, api_config, use_cache=use_cache, rate_limiter=rate_limiter)
+
+    def complete_streamed(prompt, use_cache):
+        nonlocal streamed
+        if streamed:
+            on_delta(None)  # The previous attempt was rejected, its text must be dropped
+        streamed = True
+        stream = stream_completion_json(prompt, model_config, api_config, use_cache=use_cache, rate_limiter=rate_limiter)
+        for delta in stream:
+            on_delta(delta)
+        return prompt, stream.response
+
+    def summarize_all(executor, func, prompts, kind):
+        """
+        Sends every prompt and re-asks the ones that failed (error, rejection or invalid JSON) up to
+        max_attempts times in total. Returns the summaries, with None for prompts that never succeeded.
+        """
+        nonlocal total_api_cost
+        results = [None] * len(prompts)
+        pending = list(range(len(prompts)))
+        for attempt in range(max_attempts):
+            if attempt > 0:
+                print(f"Re-asking {len(pending)} failed {kind} requests of {company} (attempt {attempt + 1}/{max_attempts}).")
+            # A cached answer would be the same failed one
+            futures = [executor.submit(func, prompts[i], use_cache and attempt == 0) for i in pending]
+            failed = []
+            for i, future in zip(pending, futures):
+                try:
+                    prompt, response = future.result()
+                except Exception as e:
+                    print(f"Error in {kind} request {i + 1}/{len(prompts)} of {company}: {e}")
+                    failed.append(i)
+                    continue
+                total_api_cost += get_response_cost(response, prompt, model_config)
+                results[i] = _parse_summary(response)
+                if results[i] is None:
+                    failed.append(i)
+            pending = failed
+            if not pending:
+                break
+        return results
+
+    chunks = split_into_chunks(reviews, chunk_tokens, model_config)
+    print(f"Summarizing {len(reviews)} reviews of {company} in {len(chunks)} chunks.")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        map_func = complete_streamed if on_delta is not None and len(chunks) == 1 else complete
+        summaries = summarize_all(executor, map_func, [map_prompt + chunk for chunk in chunks], "map")
+        missing_chunks = [i for i, summary in enumerate(summaries) if summary is None]
+        if missing_chunks:
+            print(f"Warning: {len(missing_chunks)}/{len(chunks)} chunks of {company} could not be summarized "
+                  f"after {max_attempts} attempts and are missing from the summary.")
+        summaries = [summary for summary in summaries if summary is not None]
+
+        # Merge partial summaries in groups until one is left
+        merge_budget = budget - estimate_num_tokens_from_str(merge_prompt, model_config)
+        level = 0
+        condensed = False
+        while len(summaries) > 1:
+            level += 1
+            serialized = [json.dumps(summary) for summary in summaries]
+            token_counts = pd.Series(count_tokens_batch(serialized, model_config), dtype='int64') + 1
+            groups = pack_token_batches(token_counts, merge_budget, max(2, merge_fan_in))
+            if len(groups) < len(serialized):
+                inputs = ["\n".join(serialized[i] for i in group) for group in groups]
+                condensed = False
+            elif not condensed:
+                # No two summaries fit in one request. Condense each one on its own, splitting the ones
+                # over the budget, so that the shorter results can be merged on the next level.
+                inputs = split_into_chunks(serialized, merge_budget, model_config)
+                condensed = True
+            else:
+                raise RuntimeError(f"The partial summaries of {company} are too long to merge within {merge_budget} "
+                                   "input tokens. Lower model_config.max_output or use a model with a larger input.")
+            print(f"Merging {len(summaries)} partial summaries of {company} into {len(inputs)} (level {level}).")
+
+            prompts = [merge_prompt + text for text in inputs]
+            merge_func = complete_streamed if on_delta is not None and len(inputs) == 1 else complete
+            merged = summarize_all(executor, merge_func, prompts, "merge")
+            if any(summary is None for summary in merged):
+                # Keeping one of the partial summaries would silently drop the others
+                raise RuntimeError(f"Could not merge the partial summaries of {company} after {max_attempts} attempts.")
+            summaries = merged
+
+    result = {"company": company}
+    result.update(summaries[0] if summaries else {key: [] if key != "summary" else "" for key in SUMMARY_KEYS})
+    result.update({"num_chunks": len(chunks), "missing_chunks": missing_chunks, "cost": total_api_cost})
+    print(f"Finished summarizing {company}. Cost: ${total_api_cost:.2f}")
+    return result
+
+
+def save_json(output_path, new_data):
+    temp_file_path = os.path.splitext(output_path)[0] + "_temp.json"
+    with open(temp_file_path, 'w') as temp_file:
+        json.dump(new_data, temp_file, indent=4)
+
+    # Replace the old file with the new file
+    os.replace(temp_file_path, output_path)
+
+
+def summarize_companies(company_reviews: dict, output_path: str, model_config: AzureOpenAIConfig,
+                        api_config: AzureAPIConfig, overwrite: bool = False, **kwargs):
+    """ Summarizes several companies and saves the results as a JSON list.
+
+    Params:
+    company_reviews: Dict of company name -> list of reviews
+    output_path: JSON file the summaries are saved to after every company
+    model_config: Azure openAI model configuration
+    api_configuration: Azure openAI API configuration
+    overwrite: If False, companies that already have a complete summary in output_path are skipped.
+               Summaries with missing chunks are redone.
+    kwargs: Passed on to summarize_reviews
+    """
+    if os.path.exists(output_path) and not overwrite:
+        with open(output_path, 'r') as file:
+            json_data = json.load(file)
+    else:
+        json_data = []
+    # Check which companies already have a summary that covers every review
+    skip_list = [entry.get("company") for entry in json_data if not entry.get("missing_chunks")]
+
+    for company, reviews in company_reviews.items():
+        if company in skip_list:
+            continue
+        json_data = [entry for entry in json_data if entry.get("company") != company]
+        json_data.append(summarize_reviews(company, reviews, model_config, api_config, **kwargs))
+        save_json(output_path, json_data)
+    return json_data
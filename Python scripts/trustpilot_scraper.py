@@ -16,13 +16,29 @@ import os
 import re
 import time
 import json
+import asyncio
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from random import randint
+from lxml import etree
+from lxml import html as lxml_html
+from bs4 import SoupStrainer
 from utils import *
+from fetch_engine import FetchEngine
+try:
+    from orjson import loads as json_loads  # Much faster than json for large payloads
+except ImportError:
+    from json import loads as json_loads
+from http_client import close_sessions
+from review_store import get_default_review_store
 
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Pages are parsed in the main process by default. A process pool only pays off for long runs, since
+# starting it and pickling the pages cost more than the parsing saves for a few pages per company.
+DEFAULT_PARSE_PROCESSES = 0
+
 
 class Config:
     """Loads in configuration settings for TrustPilot scraping setup.
@@ -32,6 +48,9 @@ class Config:
         names_path (str): Path to the CSV file containing names to scrape.
         output_folder (str): Directory path for saving scraped data.
         n_pages (int): Number of pages to scrape per site.
+        parser_backend (str): HTML parser used for review pages, one of PARSER_BACKENDS (optional, defaults to 'next_data').
+        parse_processes (int): Number of worker processes parsing pages (optional, defaults to DEFAULT_PARSE_PROCESSES).
+        0 parses pages in threads of the main process. Only worth raising for runs of many pages.
     """
     def __init__(self, config_path):
         with open(config_path, 'r') as file:
@@ -44,6 +63,8 @@ class Config:
         self.names_list = load_csv_list(self.names_path, self.column_name)
         self.output_folder = os.path.join(parent_dir, config['output_folder'])
         self.n_pages = config['n_pages']
+        self.parser_backend = config.get('parser_backend', 'next_data')
+        self.parse_processes = config.get('parse_processes', DEFAULT_PARSE_PROCESSES)
 
     @staticmethod
     def validate_config(config):
@@ -52,6 +73,11 @@ class Config:
         for field in required_fields:
             if field not in config:
                 raise ValueError(f"Missing required config field: {field}")
+        if config.get('parser_backend', 'next_data') not in PARSER_BACKENDS:
+            raise ValueError(f"Invalid parser_backend: {config['parser_backend']}. Use one of {list(PARSER_BACKENDS)}.")
+        parse_processes = config.get('parse_processes', DEFAULT_PARSE_PROCESSES)
+        if not isinstance(parse_processes, int) or parse_processes < 0:
+            raise ValueError(f"Invalid parse_processes: {parse_processes}. Use a number >= 0.")
 
 
 def extract_review_info(soup, company_name):
@@ -63,6 +89,11 @@ def extract_review_info(soup, company_name):
     Returns:
         DataFrame containing extracted review data.
     """
+    return _build_review_frame(extract_review_records(soup, company_name))
+
+
+def extract_review_records(soup, company_name):
+    """Same as extract_review_info, but returns a dict of review id -> row instead of a DataFrame."""
     review_cards = soup.find_all('div', class_="styles_reviewCardInner__EwDq2")
     dict = {}
 
@@ -94,12 +125,6 @@ def extract_review_info(soup, company_name):
         # Extract review text bodies
         find_tag = card.find('p', class_="typography_body-l__KUYFJ typography_appearance-default__AAY17 typography_color-black__5LYEn")
         review_content = find_tag.text if find_tag else ""
-
-        if (review_title != "") and (review_content != ""):
-            review_content = review_title + ': ' + review_content
-        elif (review_title != ""):
-            review_content = review_title
-
         
         # Extract date of ratings
         find_tag = card.find('time', attrs={'data-service-review-date-time-ago':'true'})
@@ -112,21 +137,39 @@ def extract_review_info(soup, company_name):
     
         # Extract direct links to reviews
         link_obj = card.find('a', class_="link_internal__7XN06 typography_appearance-default__AAY17 typography_color-inherit__TlgPO link_link__IZzHN link_notUnderlined__szqki")
-        review_link = 'https://www.trustpilot.com' + link_obj['href']
-        review_id = re.sub('/reviews/', '', link_obj['href'])
+        review_href = link_obj['href']
 
-        
-        metadata = {
-            "ExperienceDate": date_of_experience,
-            "AuthorName": reviewer_name,
-            "AuthorCountry": country,
-            "AuthorReviews": num_reviews,
-            "ProfileLink": profile_link,
-            "ReviewLink": review_link
-        }
-        attributes = [company_name, date_of_rating, review_content, star_rating, 'Trustpilot', metadata]
+        review_id, attributes = _build_review_record(company_name, reviewer_name, num_reviews, profile_link, country, star_rating,
+                                                     review_title, review_content, date_of_rating, date_of_experience, review_href)
         dict[review_id] = attributes
     
+    return dict
+
+
+def _build_review_record(company_name, reviewer_name, num_reviews, profile_link, country, star_rating,
+                         review_title, review_content, date_of_rating, date_of_experience, review_href):
+    """Combines the fields extracted from a review card into a (review id, row) pair."""
+    if (review_title != "") and (review_content != ""):
+        review_content = review_title + ': ' + review_content
+    elif (review_title != ""):
+        review_content = review_title
+
+    review_link = 'https://www.trustpilot.com' + review_href
+    review_id = re.sub('/reviews/', '', review_href)
+
+    metadata = {
+        "ExperienceDate": date_of_experience,
+        "AuthorName": reviewer_name,
+        "AuthorCountry": country,
+        "AuthorReviews": num_reviews,
+        "ProfileLink": profile_link,
+        "ReviewLink": review_link
+    }
+    return review_id, [company_name, date_of_rating, review_content, star_rating, 'Trustpilot', metadata]
+
+
+def _build_review_frame(dict):
+    """Builds the review DataFrame from a dict of review id -> row."""
     # Creating dataframe
     main_columns = ['CompanyName', 'ReviewDate', 'ReviewContent', 'StarRating', 'ReviewType', 'Metadata']
     df = pd.DataFrame.from_dict(dict, orient='index', columns=main_columns)
@@ -137,64 +180,296 @@ def extract_review_info(soup, company_name):
     df['ReviewDate'] = pd.to_datetime(df['ReviewDate'], utc=True).dt.tz_convert(None)
 
     return df
-    
 
-def collect_reviews(config):
-    """Collects reviews based on the configuration provided.
+
+##################################################
+#    Fast parsing backends
+##################################################
+
+REVIEW_CARD_CLASS = "styles_reviewCardInner__EwDq2"
+ERROR_404_CLASS = "errors_error404__tUqzU"
+
+# Only builds the review cards and the 404 marker instead of the whole page tree
+REVIEW_CARD_STRAINER = SoupStrainer('div', class_=re.compile(f"^(?:{REVIEW_CARD_CLASS}|{ERROR_404_CLASS})$"))
+
+
+def _xpath_class(class_str):
+    """
+    XPath condition matching BeautifulSoup's class_ semantics: a single class matches any of the
+    element's classes, several space-separated classes must match the class attribute exactly.
+    """
+    if ' ' in class_str:
+        return f"normalize-space(@class)='{class_str}'"
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_str} ')"
+
+
+def _xpath(tag, class_str=None, **attrs):
+    conditions = ([_xpath_class(class_str)] if class_str else []) + [f"@{key.replace('_', '-')}='{value}'" for key, value in attrs.items()]
+    return etree.XPath(f"(.//{tag}[{' and '.join(conditions)}])[1]" if conditions else f"(.//{tag})[1]")
+
+
+# Precompiled selectors, one per field, evaluated relative to a review card (same matches as extract_review_info)
+REVIEW_CARD_XPATH = etree.XPath(f"//div[{_xpath_class(REVIEW_CARD_CLASS)}]")
+ERROR_404_XPATH = etree.XPath(f"(//div[{_xpath_class(ERROR_404_CLASS)}])[1]")
+REVIEW_FIELD_XPATHS = {
+    "reviewer_name": _xpath('span', "typography_heading-xxs__QKBS8 typography_appearance-default__AAY17", data_consumer_name_typography='true'),
+    "num_reviews": _xpath('span', "typography_body-m__xgxZ_ typography_appearance-subtle__8_H2l", data_consumer_reviews_count_typography='true'),
+    "profile_link": _xpath('a', "link_internal__7XN06 link_wrapper__5ZJEx styles_consumerDetails__ZFieb", name='consumer-profile', data_consumer_profile_link='true'),
+    "country": _xpath('div', "typography_body-m__xgxZ_ typography_appearance-subtle__8_H2l styles_detailsIcon__Fo_ua"),
+    "star_rating": _xpath('div', "styles_reviewHeader__iU9Px"),
+    "review_title": _xpath('h2', "typography_heading-s__f7029 typography_appearance-default__AAY17"),
+    "review_content": _xpath('p', "typography_body-l__KUYFJ typography_appearance-default__AAY17 typography_color-black__5LYEn"),
+    "date_of_rating": _xpath('time', data_service_review_date_time_ago='true'),
+    "date_of_experience": _xpath('p', "typography_body-m__xgxZ_ typography_appearance-default__AAY17", data_service_review_date_of_experience_typography='true'),
+    "review_link": _xpath('a', "link_internal__7XN06 typography_appearance-default__AAY17 typography_color-inherit__TlgPO link_link__IZzHN link_notUnderlined__szqki")
+}
+
+
+def extract_review_records_lxml(tree, company_name):
+    """Extracts TrustPilot review data from an lxml tree with the precompiled REVIEW_FIELD_XPATHS.
+
+    Args:
+        tree (lxml.html.HtmlElement): Parsed HTML of the current page.
+
+    Returns:
+        Dict of review id -> row (same output as extract_review_records).
+    """
+    dict = {}
+    for card in REVIEW_CARD_XPATH(tree):
+        fields = {field: xpath(card) for field, xpath in REVIEW_FIELD_XPATHS.items()}
+        fields = {field: found[0] if found else None for field, found in fields.items()}
+        text = lambda field: fields[field].text_content() if fields[field] is not None else ""
+
+        num_reviews = int(text("num_reviews").split(' ')[0]) if fields["num_reviews"] is not None else np.nan
+        profile_link = ('https://www.trustpilot.com' + fields["profile_link"].get('href')) if fields["profile_link"] is not None else ""
+        star_rating = fields["star_rating"].get('data-service-review-rating') if fields["star_rating"] is not None else np.nan
+        date_of_rating = fields["date_of_rating"].get('datetime') if fields["date_of_rating"] is not None else np.nan
+        date_of_experience = text("date_of_experience").split(':', 1)[1].strip() if fields["date_of_experience"] is not None else np.nan
+        review_href = fields["review_link"].get('href')
+
+        review_id, attributes = _build_review_record(company_name, text("reviewer_name"), num_reviews, profile_link, text("country"), 
+                                                     star_rating, text("review_title"), text("review_content"), date_of_rating, 
+                                                     date_of_experience, review_href)
+        dict[review_id] = attributes
+    return dict
+
+
+NEXT_DATA_PATTERN = re.compile(rb'<script[^>]*\bid="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL)
+
+
+def extract_review_records_next_data(reviews, company_name):
+    """Extracts TrustPilot review data from the review list embedded in the page's Next.js data.
+
+    Args:
+        reviews (list): The 'props.pageProps.reviews' list of the page's __NEXT_DATA__ JSON.
+
+    Returns:
+        Dict of review id -> row (same output as extract_review_records).
+    """
+    dict = {}
+    for review in reviews:
+        consumer = review.get('consumer') or {}
+        dates = review.get('dates') or {}
+        experience_date = dates.get('experiencedDate')
+        num_reviews = consumer.get('numberOfReviews')
+        rating = review.get('rating')
+
+        review_id, attributes = _build_review_record(
+            company_name,
+            reviewer_name=consumer.get('displayName') or "",
+            num_reviews=int(num_reviews) if num_reviews is not None else np.nan,
+            profile_link=f"https://www.trustpilot.com/users/{consumer['id']}" if consumer.get('id') else "",
+            country=consumer.get('countryCode') or "",
+            star_rating=str(rating) if rating is not None else np.nan,  # The DOM attribute is a string too
+            review_title=review.get('title') or "",
+            review_content=review.get('text') or "",
+            date_of_rating=dates.get('publishedDate') or np.nan,
+            date_of_experience=datetime.strptime(experience_date[:10], '%Y-%m-%d').strftime('%B %d, %Y') if experience_date else np.nan,
+            review_href=f"/reviews/{review['id']}")
+        dict[review_id] = attributes
+    return dict
+
+
+def _get_next_data_reviews(html_text):
+    """Returns the review list from the page's __NEXT_DATA__ script, or None if it is missing or unexpected."""
+    match = NEXT_DATA_PATTERN.search(html_text if isinstance(html_text, bytes) else html_text.encode('utf-8'))
+    if not match:
+        return None
+    try:
+        reviews = json_loads(match.group(1))['props']['pageProps']['reviews']
+    except (ValueError, KeyError, TypeError):
+        return None
+    return reviews if isinstance(reviews, list) else None
+
+
+def _parse_soup(html_text, company_name):
+    soup = BeautifulSoup(html_text, 'lxml')
+    if soup.find('div', class_=ERROR_404_CLASS):
+        return None
+    return extract_review_records(soup, company_name)
+
+
+def _parse_strainer(html_text, company_name):
+    soup = BeautifulSoup(html_text, 'lxml', parse_only=REVIEW_CARD_STRAINER)
+    if soup.find('div', class_=ERROR_404_CLASS):
+        return None
+    return extract_review_records(soup, company_name)
+
+
+def _parse_lxml(html_text, company_name):
+    if not html_text or not html_text.strip():  # lxml refuses empty documents
+        return None
+    parser = lxml_html.HTMLParser(encoding='utf-8') if isinstance(html_text, bytes) else None
+    try:
+        tree = lxml_html.document_fromstring(html_text, parser=parser)
+    except etree.ParserError:  # e.g. a body of whitespace or comments only
+        return None
+    if ERROR_404_XPATH(tree):
+        return None
+    return extract_review_records_lxml(tree, company_name)
+
+
+def _parse_next_data(html_text, company_name):
+    reviews = _get_next_data_reviews(html_text)
+    if reviews is not None:
+        try:
+            return extract_review_records_next_data(reviews, company_name)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:  # Payload layout changed
+            print(f"Could not read embedded review data of {company_name} ({e}), falling back to the DOM parser.")
+    return _parse_lxml(html_text, company_name)  # Also detects 404 pages
+
+
+# 'soup' builds the full BeautifulSoup tree (original behaviour), 'strainer' only builds the review
+# cards with BeautifulSoup, 'lxml' evaluates precompiled XPath selectors on an lxml tree, and
+# 'next_data' reads the reviews from the page's embedded Next.js JSON, falling back to 'lxml' when
+# the payload is missing or has an unexpected layout.
+PARSER_BACKENDS = {
+    'soup': _parse_soup,
+    'strainer': _parse_strainer,
+    'lxml': _parse_lxml,
+    'next_data': _parse_next_data
+}
+
+
+def parse_review_page(html_text, company_name, backend='next_data'):
+    """Parses a fetched review page. Returns None if the page does not exist or is empty, else its reviews
+    as a list of (review id, row) tuples; _build_review_frame turns them into a DataFrame. May run in a
+    parse worker process, so it only takes and returns small picklable values.
+
+    Args:
+        html_text (bytes or str): HTML of the page.
+        company_name (str): Name written to the CompanyName column.
+        backend (str): One of PARSER_BACKENDS.
+    """
+    records = PARSER_BACKENDS[backend](html_text, company_name)
+    return list(records.items()) if records is not None else None
+
+
+async def collect_company_reviews(engine, site, config):
+    """Collects the reviews of one company, page by page, until no new reviews are found.
 
     Args:
+        engine (FetchEngine): Fetch engine shared by all companies.
+        site (str): Company website URL.
         config (Config): Configuration object containing scraping settings.
 
     Returns:
-        DataFrame of all collected reviews.
+        DataFrame of all reviews of the company.
     """
-    all_reviews = pd.DataFrame()
-        
-    for site in config.names_list:
-        company_name = extract_company_name(site)
-        print(f"\nStarting scraping of {company_name}'s TrustPilot Reviews.")
+    company_name = extract_company_name(site)
+    print(f"\nStarting scraping of {company_name}'s TrustPilot Reviews.")
 
-        start_time = time.time()
-        total_collected = 0
-        output_filepath = os.path.join(config.output_folder, f"{company_name}.csv")
-        
-        if os.path.exists(output_filepath):
-            df = pd.read_csv(output_filepath, index_col=0)
-        else:
-            df = pd.DataFrame()
-            
+    start_time = time.time()
+    total_collected = 0
+    output_filepath = os.path.join(config.output_folder, f"{company_name}.csv")
+    store = get_default_review_store()
+    dataset = f"trustpilot/{company_name}"
+
+    # Reviews collected before the store existed
+    if store.count(dataset) == 0 and os.path.exists(output_filepath):
+        store.import_csv(dataset, output_filepath)
+
+    def fetch_page(page):
+        url = f'https://www.trustpilot.com/review/{extract_domain(site)}?page={page}&sort=recency'
+        return asyncio.ensure_future(engine.fetch(url, headers=headers))  # Paced by the engine's trustpilot.com policy
+
+    next_page = fetch_page(1) if config.n_pages > 0 else None
+    try:
         for curr_page in range(1, config.n_pages + 1):
-            base_url = f'https://www.trustpilot.com/review/{extract_domain(site)}?page={curr_page}&sort=recency'
-            soup = get_website(base_url)
+            response = await next_page
+            # Queue the next page while this one is parsed. If this page turns out to be the last one, the next
+            # request is cancelled, usually while it is still waiting for its trustpilot.com slot
+            next_page = fetch_page(curr_page + 1) if curr_page < config.n_pages else None
+
+            # Error pages (and offline cache misses) end the company like a missing page
+            if response.status_code != 200:
+                print(f"Got {response.status_code} for page {curr_page} of {company_name}, stopping.")
+                break
+            records = await engine.parse(parse_review_page, response.content, company_name, config.parser_backend)
 
             # Exit loop if page does not exist
-            if soup.find('div', class_="errors_error404__tUqzU"):
+            if records is None:
                 break
-    
-            new_reviews = extract_review_info(soup, company_name)
-
-            # Check if any review in new_reviews is already in all_reviews
-            if df.empty:
-                df = new_reviews
-            elif not df.empty and not new_reviews[~new_reviews.index.isin(df.index)].empty:
-                new_reviews = new_reviews[~new_reviews.index.isin(df.index)]
-                df = pd.concat([df, new_reviews])
-            else:
-                # If no new reviews, stop fetching more pages
-                time.sleep(randint(2, 5))
+            new_reviews = _build_review_frame(dict(records))
+
+            # Only appends the reviews that are not stored yet. If there are none, stop fetching more pages.
+            # The parse workers never touch the store, every write happens here, on the event loop
+            n_new = store.append(dataset, new_reviews, keep='first')
+            if n_new == 0:
                 break
+            total_collected += n_new
+    finally:
+        if next_page is not None:
+            if next_page.done():
+                next_page.exception()  # Marks a failed request for a page that is not needed as handled
+            else:
+                next_page.cancel()
+
+    if total_collected > 0:
+        store.export_csv(dataset, output_filepath)  # The CSV is only rewritten once per company
+    df = store.read(dataset)
+    end_time = time.time()
+    duration_requests = end_time - start_time
+    print(f"Finished scraping {company_name}.")
+    print(f"Collected {total_collected} new reviews.")
+    print(f"Total time: {round(duration_requests, 2)} seconds.\n\n")
+    return df
+
+
+async def collect_reviews_async(config, engine=None):
+    """Collects the reviews of every company concurrently. Requests are paced per host by the engine.
 
-            total_collected += len(new_reviews)
-            df.to_csv(output_filepath)
-            time.sleep(randint(2, 5))
-                
-        end_time = time.time()
-        duration_requests = end_time - start_time
-        print(f"Finished scraping {company_name}.")
-        print(f"Collected {total_collected} new reviews.")
-        print(f"Total time: {round(duration_requests, 2)} seconds.\n\n")
-        all_reviews = pd.concat([all_reviews, df])
-    return all_reviews
+    Args:
+        config (Config): Configuration object containing scraping settings.
+        engine (FetchEngine): Optional engine to share with other scrapers. A new one is used if None.
+
+    Returns:
+        DataFrame of all collected reviews.
+    """
+    if engine is None:
+        # Parsing is CPU work that holds the GIL. With parse_processes set, pages are parsed in worker
+        # processes, in parallel with each other and with the requests
+        executor = ProcessPoolExecutor(max_workers=config.parse_processes) if config.parse_processes > 0 else None
+        try:
+            async with FetchEngine(parse_executor=executor) as engine:
+                return await collect_reviews_async(config, engine)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+    results = await asyncio.gather(*[collect_company_reviews(engine, site, config) for site in config.names_list])
+    return pd.concat(results) if results else pd.DataFrame()
+
+
+def collect_reviews(config):
+    """Collects reviews based on the configuration provided.
+
+    Args:
+        config (Config): Configuration object containing scraping settings.
+
+    Returns:
+        DataFrame of all collected reviews.
+    """
+    return asyncio.run(collect_reviews_async(config))
 
 
 def main(config_file):
@@ -207,6 +482,7 @@ def main(config_file):
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
     finally:
+        close_sessions()
         print("[✓] Execution complete.")
 
 
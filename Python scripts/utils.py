@@ -2,12 +2,12 @@
 import os
 import re
 import html
-import requests
 import pandas as pd
 from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 from alive_progress import alive_bar
 from typing import ContextManager, Optional
+from http_client import fetch
 
 
 headers = {
@@ -113,8 +113,9 @@ def load_csv_list(filepath: str, column: str) -> list:
 
 def get_website(url: str) -> BeautifulSoup:
     """ Fetches HTML content of site and returns it as a BeautifulSoup object.
+    Pages are fetched through the shared, pooled session in http_client.
     """
-    response = requests.get(url, headers=headers)
+    response = fetch(url, headers=headers)
     html_text = response.content
     soup = BeautifulSoup(html_text, 'lxml')
     return soup
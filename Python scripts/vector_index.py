@@ -0,0 +1,249 @@
+"""
+Local vector index for similarity search over review embeddings.
+
+Loads the float32 matrices written by azure_openai_cookbook.embed_column (a .npy file plus its
+'<name>_ids.json' sidecar) and answers top-k cosine similarity queries in-process, without a
+round trip to a hosted search service. Two search modes are available:
+    - Exact: one matrix multiplication per batch of queries over all (or the filtered) rows.
+    - Approximate (IVF): rows are clustered around n_lists centroids with k-means, and a query
+      only scores the rows of its n_probe closest clusters. Call build_ivf() once, then save().
+
+Results can be restricted to rows matching metadata values (e.g. a venue_id or CompanyName).
+Row positions for every value of the filter columns are precomputed, so a filter costs a set
+lookup instead of a scan over the metadata.
+
+Usage:
+    reviews = load_review_metadata("Scraped data/azure_index_data/full_venue_reviews.json")
+    index = VectorIndex.from_embedding_files("venue_reviews.npy", reviews, filter_cols=['VenueName'])
+    index.build_ivf()
+    index.save("venue_reviews_index")
+    results = index.search(query_vectors, k=5, filters={'VenueName': 'Rickshaw Stop'})
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_review_metadata(json_path: str) -> pd.DataFrame:
+    """Reads a review JSON file (a list of records, as in 'azure_index_data') into a DataFrame."""
+    with open(json_path, 'r', encoding='utf-8') as file:
+        return pd.DataFrame.from_records(json.load(file))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1  # Zero vectors (e.g. rows that were not embedded) stay zero
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, k: int):
+    """Returns the positions and scores of the k highest scores in each row, best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=np.float32)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+class VectorIndex:
+    """In-memory cosine similarity index over a matrix of embeddings.
+
+    Attributes:
+        vectors (np.ndarray): Unit-normalized float32 matrix, one row per item.
+        row_ids (list): Identifier of each row (the DataFrame index the embeddings came from).
+        metadata (pd.DataFrame): Optional per-row metadata, aligned with vectors.
+        skipped_row_ids (list): Row ids left out of the index because their vector is all zeros
+        (empty or failed embeddings), so they cannot fill result slots with a score of 0.
+        filter_cols (list): Metadata columns that can be used in search filters.
+        centroids (np.ndarray): IVF cluster centroids, or None if the IVF index has not been built.
+        assignments (np.ndarray): IVF cluster of every row, or None.
+    """
+    def __init__(self, vectors: np.ndarray, row_ids: list = None, metadata: pd.DataFrame = None, filter_cols: list = None):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        row_ids = list(row_ids) if row_ids is not None else list(range(len(vectors)))
+        if len(row_ids) != len(vectors):
+            raise ValueError(f"Got {len(row_ids)} row ids for {len(vectors)} vectors.")
+        keep = np.flatnonzero(np.any(vectors != 0, axis=1))
+        self.skipped_row_ids = [row_ids[row] for row in np.setdiff1d(np.arange(len(vectors)), keep)]
+        if self.skipped_row_ids:
+            print(f"Skipped {len(self.skipped_row_ids)} rows with all-zero embeddings.")
+            vectors, row_ids = vectors[keep], [row_ids[row] for row in keep]
+            metadata = metadata.iloc[keep] if metadata is not None else None
+        self.vectors = _normalize(vectors)
+        self.row_ids = row_ids
+        self.metadata = metadata.reset_index(drop=True) if metadata is not None else None
+        self.filter_cols = list(filter_cols or [])
+        self.centroids = None
+        self.assignments = None
+        self._cluster_rows = None
+        self._filter_rows = {}
+        self._build_filter_lookup()
+
+    @classmethod
+    def from_embedding_files(cls, matrix_path: str, metadata: pd.DataFrame = None, filter_cols: list = None):
+        """Loads a matrix written by embed_column along with its row-id sidecar.
+
+        If metadata is given, its rows are matched to the embeddings by row id (its index).
+        """
+        vectors = np.load(matrix_path, mmap_mode='r')
+        with open(os.path.splitext(matrix_path)[0] + '_ids.json', 'r') as file:
+            row_ids = json.load(file)['row_ids']
+        if metadata is not None:
+            metadata = metadata.reindex(row_ids)
+        return cls(vectors, row_ids, metadata, filter_cols)
+
+    def _build_filter_lookup(self):
+        self._filter_rows = {}
+        if self.metadata is None:
+            return
+        for col in self.filter_cols:
+            if col not in self.metadata.columns:
+                raise ValueError(f"Missing filter column in metadata: {col}")
+            self._filter_rows[col] = {value: np.asarray(rows, dtype=np.int64) for value, rows in self.metadata.groupby(col).indices.items()}
+
+    def _get_candidate_rows(self, filters: dict):
+        """Returns the sorted row positions matching every filter, or None if there are no filters."""
+        if not filters:
+            return None
+        candidates = None
+        for col, values in filters.items():
+            if col not in self._filter_rows:
+                raise ValueError(f"Column '{col}' is not a filter column. Available: {self.filter_cols}")
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            rows = [self._filter_rows[col][value] for value in values if value in self._filter_rows[col]]
+            rows = np.unique(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+        return candidates
+
+    def build_ivf(self, n_lists: int = None, n_iter: int = 10, sample_size: int = 50000, seed: int = 0):
+        """Clusters the rows with spherical k-means for approximate search.
+
+        Args:
+            n_lists: Number of clusters. Defaults to about sqrt(number of rows).
+            n_iter: Number of k-means iterations.
+            sample_size: Max number of rows used to train the centroids.
+            seed: Random seed for the initial centroids and the training sample.
+        """
+        n_rows = len(self.vectors)
+        if n_rows == 0:
+            raise ValueError("Cannot build an IVF index without vectors (every row was empty or all zeros).")
+        n_lists = min(n_rows, n_lists or max(1, int(np.sqrt(n_rows))))
+        rng = np.random.default_rng(seed)
+        sample = self.vectors[rng.choice(n_rows, size=min(sample_size, n_rows), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=n_lists) == 0
+            sums[empty] = centroids[empty]  # Keep the old centroid for empty clusters
+            centroids = _normalize(sums)
+
+        self.centroids = centroids
+        self.assignments = np.concatenate([np.argmax(batch @ centroids.T, axis=1)
+                                           for batch in np.array_split(self.vectors, max(1, n_rows // 10000))])
+        self._build_cluster_lookup()
+
+    def _build_cluster_lookup(self):
+        order = np.argsort(self.assignments, kind='stable')
+        bounds = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+        self._cluster_rows = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def search(self, queries: np.ndarray, k: int = 10, filters: dict = None, approximate: bool = False, n_probe: int = 8):
+        """Finds the k most similar rows for each query vector.
+
+        Args:
+            queries: A single query vector or a (n_queries, dim) matrix.
+            k: Number of results per query.
+            filters: Dict of filter column -> value or list of values that results must match.
+            approximate: If True, use the IVF index (see build_ivf) and only score n_probe clusters.
+            n_probe: Number of closest clusters searched per query in approximate mode.
+
+        Returns:
+            DataFrame with one row per result: query (position of the query), rank, row_id, score,
+            plus the metadata columns of the matching row.
+        """
+        queries = _normalize(np.atleast_2d(queries))
+        candidates = self._get_candidate_rows(filters)
+
+        if approximate:
+            if self.centroids is None:
+                raise ValueError("IVF index has not been built. Call build_ivf() first.")
+            positions, scores = self._search_ivf(queries, k, candidates, n_probe)
+        else:
+            vectors = self.vectors if candidates is None else self.vectors[candidates]
+            top, scores = _top_k(queries @ vectors.T, k)
+            positions = top if candidates is None else candidates[top]
+        return self._format_results(positions, scores)
+
+    def _search_ivf(self, queries, k, candidates, n_probe):
+        n_probe = min(n_probe, len(self.centroids))
+        probes, _ = _top_k(queries @ self.centroids.T, n_probe)
+        all_positions = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            rows = np.concatenate([self._cluster_rows[cluster] for cluster in probes[i]])
+            if candidates is not None:
+                rows = np.intersect1d(rows, candidates)
+            top, scores = _top_k((self.vectors[rows] @ query)[None, :], k)
+            all_positions[i, :top.shape[1]] = rows[top[0]]
+            all_scores[i, :top.shape[1]] = scores[0]
+        return all_positions, all_scores
+
+    def _format_results(self, positions, scores):
+        query_num, rank = np.nonzero(positions >= 0)
+        rows = positions[query_num, rank]
+        results = pd.DataFrame({
+            "query": query_num,
+            "rank": rank,
+            "row_id": [self.row_ids[row] for row in rows],
+            "score": scores[query_num, rank]
+        })
+        if self.metadata is not None:
+            results = pd.concat([results, self.metadata.iloc[rows].reset_index(drop=True)], axis=1)
+        return results
+
+    def save(self, folder: str):
+        """Saves the vectors, row ids, metadata and IVF index (if built) to a folder."""
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'vectors.npy'), self.vectors)
+        with open(os.path.join(folder, 'index.json'), 'w') as file:
+            json.dump({"row_ids": self.row_ids, "filter_cols": self.filter_cols, "skipped_row_ids": self.skipped_row_ids},
+                      file, default=str)
+        if self.metadata is not None:
+            self.metadata.to_pickle(os.path.join(folder, 'metadata.pkl'))
+        if self.centroids is not None:
+            np.save(os.path.join(folder, 'ivf_centroids.npy'), self.centroids)
+            np.save(os.path.join(folder, 'ivf_assignments.npy'), self.assignments)
+
+    @classmethod
+    def load(cls, folder: str):
+        """Loads an index saved with save(). The vectors are memory-mapped rather than read into memory."""
+        with open(os.path.join(folder, 'index.json'), 'r') as file:
+            info = json.load(file)
+        metadata_path = os.path.join(folder, 'metadata.pkl')
+        metadata = pd.read_pickle(metadata_path) if os.path.exists(metadata_path) else None
+
+        index = cls.__new__(cls)
+        index.vectors = np.load(os.path.join(folder, 'vectors.npy'), mmap_mode='r')  # Already normalized
+        index.row_ids = info['row_ids']
+        index.skipped_row_ids = info['skipped_row_ids']
+        index.metadata = metadata
+        index.filter_cols = info['filter_cols']
+        index.centroids = None
+        index.assignments = None
+        index._cluster_rows = None
+        index._build_filter_lookup()
+        if os.path.exists(os.path.join(folder, 'ivf_centroids.npy')):
+            index.centroids = np.load(os.path.join(folder, 'ivf_centroids.npy'))
+            index.assignments = np.load(os.path.join(folder, 'ivf_assignments.npy'))
+            index._build_cluster_lookup()
+        return index